@@ -33,9 +33,12 @@ def randomize_list(l):
 #         return person in self.blacklist
 
 class BlacklistNode:
-    def __init__(self, value=""):
+    def __init__(self, value="", blacklist=None):
         self.value = value # this will be a person key
         self.children = [] # list of nodes
+        if blacklist is None:
+            blacklist = db.get(value).blacklist
+        self.blacklist = blacklist
 
     def __str__(self):
         str = "%s: [" % self.value
@@ -50,7 +53,7 @@ class BlacklistNode:
     def maybe_add_child(self, node):
         if node == self:
             return
-        if node.value in db.get(self.value).blacklist:
+        if node.value in self.blacklist:
             return
         self.children.append(node)
 
@@ -61,12 +64,17 @@ class NoCycleFoundError(Exception):
     return repr(self.value)
 
 class BlacklistGraph:
-    def __init__(self, items=[]):
+    def __init__(self, items=[], loader=None):
         if not items:
             self.nodes = []
             return
 
-        self.nodes = [BlacklistNode(x) for x in items]
+        if loader:
+            # fetch every person once up front instead of once per edge
+            people = loader.get_many(items)
+            self.nodes = [BlacklistNode(x.key(), x.blacklist) for x in people]
+        else:
+            self.nodes = [BlacklistNode(x) for x in items]
         self.create_eligible_edges()
 
     def __str__(self):
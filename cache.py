@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# author: Jesse Shieh (jesse.shieh@gmail.com)
+#
+# Read-through caching of Game entities and their roster summaries.  Uses
+# memcache when running on App Engine and a simple in-memory dictionary
+# otherwise.  Anything that writes a Game, one of its Persons or its
+# roster summary must call invalidate_game() afterwards.
+#
+# A game's entries are stored under a generation token that
+# invalidate_game() replaces, so a read that raced with a write and
+# refills the cache with what it loaded before the write is never used.
+#
+# Assignment maps never change once drawn, so they are also kept in a
+# small per-instance LRU cache in front of memcache.
+
+import os
+import random
+import time
+from google.appengine.ext import db
+
+try:
+  from google.appengine.api import memcache
+  from google.appengine.datastore import entity_pb
+except ImportError:
+  memcache = None
+  entity_pb = None
+
+GAME_TIMEOUT = 60 * 60 # seconds
+MAX_CAS_TRIES = 10 # compare-and-set attempts before update() just sets
+ASSIGNMENTS_TIMEOUT = 24 * 60 * 60 # seconds
+
+class LocalMemcache:
+  """
+  In-memory stand-in for memcache for local runs.  Only implements the
+  parts of the memcache api we use.
+  """
+  def __init__(self):
+    self.values = {} # key -> (value, expires)
+
+  def get(self, key):
+    if key not in self.values:
+      return None
+    value, expires = self.values[key]
+    if expires and expires < _now():
+      del self.values[key]
+      return None
+    return value
+
+  def set(self, key, value, time=0):
+    expires = 0
+    if time:
+      expires = _now() + time
+    self.values[key] = (value, expires)
+    return True
+
+  def delete(self, key):
+    self.values.pop(key, None)
+    return 2
+
+  def add(self, key, value, time=0):
+    if self.get(key) is not None:
+      return False
+    return self.set(key, value, time)
+
+  def incr(self, key, delta=1):
+    value = self.get(key)
+    if value is None:
+      return None
+    self.values[key] = (value + delta, self.values[key][1])
+    return value + delta
+
+  def decr(self, key, delta=1):
+    value = self.get(key)
+    if value is None:
+      return None
+    self.values[key] = (max(0, value - delta), self.values[key][1])
+    return max(0, value - delta)
+
+  def get_multi(self, keys, key_prefix=""):
+    result = {}
+    for key in keys:
+      value = self.get(key_prefix + key)
+      if value is not None:
+        result[key] = value
+    return result
+
+  def set_multi(self, mapping, time=0, key_prefix=""):
+    for key, value in mapping.items():
+      self.set(key_prefix + key, value, time)
+    return []
+
+  def delete_multi(self, keys, key_prefix=""):
+    for key in keys:
+      self.delete(key_prefix + key)
+    return True
+
+  # a single process can't race with itself, so cas always succeeds
+  def gets(self, key):
+    return self.get(key)
+
+  def cas(self, key, value, time=0):
+    return self.set(key, value, time)
+
+class LRUCache:
+  """
+  Bounded, per-instance cache that evicts the least recently used entry
+  when full and drops entries older than ttl seconds.
+  """
+  def __init__(self, max_size=500, ttl=10 * 60):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.values = {} # key -> (value, expires)
+    self.order = [] # keys, least recently used first
+
+  def get(self, key):
+    if key not in self.values:
+      return None
+    value, expires = self.values[key]
+    self.order.remove(key)
+    if expires < _now():
+      del self.values[key]
+      return None
+    self.order.append(key)
+    return value
+
+  def set(self, key, value):
+    if key in self.values:
+      self.order.remove(key)
+    elif len(self.values) >= self.max_size:
+      oldest = self.order.pop(0)
+      del self.values[oldest]
+    self.values[key] = (value, _now() + self.ttl)
+    self.order.append(key)
+
+def _now():
+  return time.time()
+
+assignment_maps = LRUCache()
+
+if memcache is None or not os.environ.get("SERVER_SOFTWARE"):
+  client = LocalMemcache()
+  cas_client = client
+else:
+  client = memcache
+  cas_client = memcache.Client()
+
+def update(key, fn, time=0):
+  """
+  Replaces the value under key with fn(value), where value is None if
+  there isn't one, and returns the new value.  Uses compare-and-set so
+  concurrent updates aren't lost, so fn may be called more than once.
+  """
+  for i in range(MAX_CAS_TRIES):
+    value = cas_client.gets(key)
+    if value is None:
+      value = fn(None)
+      if cas_client.add(key, value, time=time):
+        return value
+    else:
+      value = fn(value)
+      if cas_client.cas(key, value, time=time):
+        return value
+  value = fn(cas_client.get(key))
+  cas_client.set(key, value, time=time)
+  return value
+
+def serialize(entity):
+  if entity_pb is None:
+    return entity
+  return db.model_to_protobuf(entity).Encode()
+
+def deserialize(data):
+  if entity_pb is None:
+    return data
+  return db.model_from_protobuf(entity_pb.EntityProto(data))
+
+def generation_key(game_key):
+  return "generation:%s" % game_key
+
+def generation(game_key):
+  """
+  Returns the token the game's cache entries are currently stored under
+  """
+  key = generation_key(game_key)
+  token = client.get(key)
+  if token is None:
+    token = "%016x" % random.getrandbits(64)
+    if not client.add(key, token):
+      token = client.get(key) or token
+  return token
+
+def game_cache_key(game_key, token):
+  return "game:%s:%s" % (game_key, token)
+
+def roster_cache_key(game_key, token):
+  return "roster:%s:%s" % (game_key, token)
+
+def get_game(game_key):
+  """
+  Returns the Game for game_key, reading through the cache
+  """
+  key = game_cache_key(game_key, generation(game_key))
+  data = client.get(key)
+  if data is not None:
+    return deserialize(data)
+
+  game = db.get(game_key)
+  if game:
+    client.set(key, serialize(game), time=GAME_TIMEOUT)
+  return game
+
+def get_roster_summary(game_key, load):
+  """
+  Returns the game's roster summary, reading through the cache.  load is
+  called with game_key to read it on a miss.
+  """
+  key = roster_cache_key(game_key, generation(game_key))
+  summary = client.get(key)
+  if summary is not None:
+    return summary
+
+  summary = load(game_key)
+  try:
+    client.set(key, summary, time=GAME_TIMEOUT)
+  except ValueError:
+    # too big for a single memcache value, just don't cache it
+    pass
+  return summary
+
+def invalidate_game(game_key):
+  """
+  Retires the cached Game and roster summary.  Call after any write to
+  either.
+  """
+  client.set(generation_key(game_key), "%016x" % random.getrandbits(64))
+
+def assignments_cache_key(game_key, version):
+  return "assignments:%s:%d" % (game_key, version)
+
+def get_assignment_map(game):
+  """
+  Returns (receivers, givers) for a drawn game, where receivers maps each
+  giver key string to their receiver's key string and givers is the
+  reverse.  Checks the local LRU cache, then memcache, and only then
+  builds it from game.assignments.
+  """
+  key = assignments_cache_key(game.key(), game.assignment_version)
+  maps = assignment_maps.get(key)
+  if maps is not None:
+    return maps
+
+  maps = client.get(key)
+  if maps is None:
+    # x gives gift to x+1
+    cycle = [str(x) for x in game.assignments]
+    receivers = {}
+    givers = {}
+    for i in range(len(cycle)):
+      receivers[cycle[i]] = cycle[(i + 1) % len(cycle)]
+      givers[cycle[(i + 1) % len(cycle)]] = cycle[i]
+    maps = (receivers, givers)
+    client.set(key, maps, time=ASSIGNMENTS_TIMEOUT)
+
+  assignment_maps.set(key, maps)
+  return maps
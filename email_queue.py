@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# author: Jesse Shieh (jesse.shieh@gmail.com)
+#
+# Buffers taskqueue tasks and adds them in batches, so fanning out emails
+# costs one RPC per MAX_TASKS_PER_ADD tasks instead of one per task.
+# Also decides which of the email lanes in queue.yaml each email uses, and
+# spreads each game's emails out over time so that games with email
+# waiting share their lane evenly.
+#
+# Email tasks are named after their type, game, recipients and content
+# (see email_task_name()), so the same email queued twice within
+# DEDUPE_WINDOW, by a retry or a double click, is dropped by the queue.
+
+import hashlib
+import time
+import urllib
+import cache
+from google.appengine.api.labs import taskqueue
+from google.appengine.api.labs.taskqueue import Task
+
+MAX_TASKS_PER_ADD = 100 # most tasks the api accepts in one add
+DEDUPE_WINDOW = 60 * 60 # seconds the same email is only sent once for
+
+# email worker url -> queue.  critical mail keeps its own rate no matter
+# how much is waiting in the other lanes
+EMAIL_LANES = {
+  '/tasks/email/creation': 'email-critical',
+  '/tasks/email/invitation': 'email-critical',
+  '/tasks/email/assignment': 'email-critical',
+  '/tasks/email/reminder': 'email-reminder',
+  '/tasks/email/notification': 'email-notification',
+  '/tasks/email/message': 'email-notification',
+  '/tasks/email/public_message': 'email-board',
+  '/tasks/email/board_digest': 'email-board',
+  }
+DEFAULT_LANE = 'email-notification'
+
+# attempts an email gets on each lane before it's stored as a FailedEmail
+# instead.  queue.yaml's retry_parameters set the backoff between them
+EMAIL_RETRY_LIMITS = {
+  'email-critical': 8,
+  'email-reminder': 4,
+  'email-notification': 5,
+  'email-board': 3,
+  }
+
+# tasks per minute for each lane, keep in line with queue.yaml.  each task
+# carries up to TaskBuffer.batch_size recipients, which follows the send
+# rate, so the email rate of a lane grows with it
+LANE_RATES = {
+  'email-critical': 60,
+  'email-reminder': 20,
+  'email-notification': 20,
+  'email-board': 10,
+  }
+
+ACTIVE_GAMES_TIMEOUT = 24 * 60 * 60 # seconds, backlogs are much shorter
+
+def email_lane(url):
+  """
+  Returns the queue for tasks sent to the email worker at url
+  """
+  return EMAIL_LANES.get(url, DEFAULT_LANE)
+
+def email_retry_limit(url):
+  """
+  Returns how many attempts the email worker at url gets
+  """
+  return EMAIL_RETRY_LIMITS[email_lane(url)]
+
+def params_digest(params):
+  """
+  Returns a hash of a dictionary of task params that doesn't depend on
+  their order or on whether the values are str or unicode
+  """
+  items = []
+  for key in sorted(params.keys()):
+    value = params[key]
+    if isinstance(value, unicode):
+      value = value.encode("utf-8")
+    items.append((key, str(value)))
+  return hashlib.md5(urllib.urlencode(items)).hexdigest()
+
+def email_task_name(url, params):
+  """
+  Returns a task name that is the same for the same email (type, game,
+  recipients and content all come from url and params) within one
+  DEDUPE_WINDOW
+  """
+  return "%s-%s-%d" % (url.strip("/").replace("/", "-"),
+                       params_digest(params),
+                       int(time.time() / DEDUPE_WINDOW))
+
+def email_task(url, params, countdown=0):
+  """
+  Returns a Task for url named so that duplicates are dropped
+  """
+  return Task(name=email_task_name(url, params), url=url, params=params,
+              countdown=countdown)
+
+def add_tasks(queue_name, tasks):
+  """
+  Adds tasks to queue_name, skipping the ones whose name was already used
+  """
+  try:
+    taskqueue.Queue(queue_name).add(tasks)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    if len(tasks) == 1:
+      return
+    # some of the batch may have gone in, try them one at a time
+    for task in tasks:
+      try:
+        add_tasks(queue_name, [task])
+      except taskqueue.BadTaskStateError:
+        pass # it was one of the ones that did
+
+def queue_email(url, params):
+  """
+  Queues a single email task on its lane, unless it's a duplicate
+  """
+  add_tasks(email_lane(url), [email_task(url, params)])
+
+def reserve_game_slots(queue_name, game_key, count):
+  """
+  Reserves slots for count tasks on queue_name for a game and returns
+  the countdown in seconds for each one, starting after any slots the
+  game already has.  The lane's task rate is split evenly between the
+  games that still have tasks scheduled on it, so a game alone on an
+  idle lane gets all of it and a small game never waits behind a big
+  game's backlog.
+  """
+  game_key = str(game_key)
+  rate = LANE_RATES.get(queue_name, LANE_RATES[DEFAULT_LANE])
+  countdowns = []
+
+  def reserve(scheduled):
+    now = time.time()
+    active = {} # game key -> when its scheduled tasks run out
+    for other_key, end in (scheduled or {}).items():
+      if end > now:
+        active[other_key] = end
+    others = len([x for x in active if x != game_key])
+    spacing = 60.0 * (others + 1) / rate
+    start = max(now, active.get(game_key, now))
+    active[game_key] = start + count * spacing
+    countdowns[:] = [int(start - now + i * spacing) for i in range(count)]
+    return active
+
+  cache.update("fair:%s" % queue_name, reserve, time=ACTIVE_GAMES_TIMEOUT)
+  return countdowns
+
+class TaskBuffer:
+  def __init__(self, batch_size=1):
+    self.batch_size = batch_size # most recipients per email task
+    self.tasks = {} # queue name -> list of Tasks
+    self.names = set() # names of buffered tasks, the api refuses repeats
+    self.game_tasks = {} # (queue name, game key) -> list of (url, params)
+
+  def add_for_game(self, game_key, url, params, queue_name=None):
+    """
+    Buffers an email task that is part of a fan-out for one game.  When
+    flushed, the game's tasks are spaced out by reserve_game_slots(), and
+    tasks that only differ by invitee_key are merged into batches.
+    """
+    if queue_name is None:
+      queue_name = email_lane(url)
+    pending = self.game_tasks.setdefault((queue_name, str(game_key)), [])
+    pending.append((url, params))
+
+  def batches(self, pending):
+    """
+    Merges (url, params) pairs that only differ by invitee_key into tasks
+    for up to batch_size recipients, listed in invitee_keys.  Returns
+    (url, params) for each task, in order.
+    """
+    batches = []
+    open_batches = {} # (url, shared params) -> batch still being filled
+    for url, params in pending:
+      if self.batch_size <= 1 or 'invitee_key' not in params:
+        batches.append((url, params, None))
+        continue
+      shared = dict(params)
+      invitee_key = shared.pop('invitee_key')
+      group = (url, tuple(sorted(shared.items())))
+      batch = open_batches.get(group)
+      if batch is None or len(batch[2]) >= self.batch_size:
+        batch = (url, shared, [])
+        open_batches[group] = batch
+        batches.append(batch)
+      batch[2].append(invitee_key)
+
+    result = []
+    for url, params, invitee_keys in batches:
+      if invitee_keys is not None:
+        params['invitee_keys'] = ",".join(invitee_keys)
+      result.append((url, params))
+    return result
+
+  def add(self, task, queue_name=None):
+    """
+    Buffers task for queue_name, adding a batch as soon as one is full.
+    Defaults to the email lane for the task's url.
+    """
+    if queue_name is None:
+      queue_name = email_lane(task.url)
+    if task.name:
+      if task.name in self.names:
+        return
+      self.names.add(task.name)
+    tasks = self.tasks.setdefault(queue_name, [])
+    tasks.append(task)
+    if len(tasks) >= MAX_TASKS_PER_ADD:
+      self.flush_queue(queue_name)
+
+  def flush_queue(self, queue_name):
+    tasks = self.tasks.pop(queue_name, [])
+    for i in range(0, len(tasks), MAX_TASKS_PER_ADD):
+      add_tasks(queue_name, tasks[i:i + MAX_TASKS_PER_ADD])
+    # lets flush() spot repeats before it reserves slots for them
+    names = [x.name for x in tasks if x.name]
+    if names:
+      cache.client.set_multi(dict([(x, True) for x in names]),
+                             time=DEDUPE_WINDOW, key_prefix="queued:")
+
+  def flush(self):
+    """
+    Adds everything that is still buffered.  Must be called before the
+    request finishes or the tasks are lost.
+    """
+    game_tasks = self.game_tasks
+    self.game_tasks = {}
+    for (queue_name, game_key), pending in game_tasks.items():
+      # leave out tasks that were already queued, by a retry of the same
+      # fan-out for example, so they don't take up the game's slots
+      batches = [(url, params, email_task_name(url, params))
+                 for url, params in self.batches(pending)]
+      queued = cache.client.get_multi([x[2] for x in batches],
+                                      key_prefix="queued:")
+      batches = [x for x in batches
+                 if x[2] not in queued and x[2] not in self.names]
+      countdowns = reserve_game_slots(queue_name, game_key, len(batches))
+      for i in range(len(batches)):
+        url, params, name = batches[i]
+        self.add(Task(name=name, url=url, params=params,
+                      countdown=countdowns[i]), queue_name)
+
+    for queue_name in self.tasks.keys():
+      self.flush_queue(queue_name)
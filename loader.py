@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# author: Jesse Shieh (jesse.shieh@gmail.com)
+#
+# Request-scoped entity loader.  Collects datastore keys, fetches the
+# missing ones with a single batched db.get() and remembers every entity
+# it has seen for the rest of the request.  Also has helpers for writing
+# entities in batches.
+
+from google.appengine.ext import db
+
+MAX_BATCH_PUT = 500 # most entities the datastore accepts in one put
+
+class EntityLoader:
+  def __init__(self):
+    self.entities = {} # db.Key -> entity (or None if it doesn't exist)
+
+  def prime(self, keys):
+    """
+    Fetches every key that hasn't been loaded yet in one db.get() call
+    """
+    missing = []
+    seen = set()
+    for key in keys:
+      if key not in self.entities and key not in seen:
+        seen.add(key)
+        missing.append(key)
+    if not missing:
+      return
+    for key, entity in zip(missing, db.get(missing)):
+      self.entities[key] = entity
+
+  def get(self, key):
+    """
+    Returns the entity for a single key, fetching it only once per request
+    """
+    self.prime([key])
+    return self.entities[key]
+
+  def get_many(self, keys):
+    """
+    Returns the entities for a list of keys, in the same order.  Missing
+    entities are returned as None, just like db.get()
+    """
+    self.prime(keys)
+    return [self.entities[key] for key in keys]
+
+  def remember(self, entities):
+    """
+    Stores entities that were loaded or written some other way so later
+    lookups don't go back to the datastore
+    """
+    for entity in entities:
+      self.entities[entity.key()] = entity
+
+  def forget(self, keys):
+    """
+    Drops cached entities so the next lookup re-reads them
+    """
+    for key in keys:
+      self.entities.pop(key, None)
+
+def allocate_keys(model_class, count):
+  """
+  Reserves count ids for model_class and returns them as complete keys,
+  so entities can reference each other before any of them are written
+  """
+  if count <= 0:
+    return []
+  kind = model_class.kind()
+  start, end = db.allocate_ids(db.Key.from_path(kind, 1), count)
+  return [db.Key.from_path(kind, id) for id in range(start, end + 1)]
+
+def put_batched(entities, batch_size=MAX_BATCH_PUT):
+  """
+  Writes entities with as few db.put() calls as possible, in order
+  """
+  for i in range(0, len(entities), batch_size):
+    db.put(entities[i:i + batch_size])
@@ -2,15 +2,25 @@
 # author: Jesse Shieh (jesse.shieh@gmail.com)
 
 import Cookie
+import calendar
+import codecs
 import copy
+import csv
+import hashlib
 import logging
-import os
 import random
 import re
 import time
 import urllib
 import wsgiref.handlers
 from blacklist import BlacklistGraph, NoCycleFoundError, randomize_list
+import cache
+from email_queue import TaskBuffer, email_lane, email_task, queue_email
+from email_queue import add_tasks, email_task_name, params_digest, DEDUPE_WINDOW
+from email_queue import email_retry_limit
+from send_rate import SendRateController
+import templates
+from loader import EntityLoader, allocate_keys, put_batched
 from datetime import datetime, timedelta
 from google.appengine.api import mail
 from google.appengine.api.labs.taskqueue import Task
@@ -18,12 +28,92 @@ from google.appengine.api import urlfetch
 from google.appengine.ext import db
 from google.appengine.ext.db import BadKeyError
 from google.appengine.ext import webapp
-from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp.util import run_wsgi_app
+from django.utils import simplejson
 import facebook
 
 debug_mode = True
 
+send_rate_controller = SendRateController()
+
+IMPORT_CHUNK_SIZE = 200 # lines handled by each ImportInviteesWorker task
+BROADCAST_PAGE_SIZE = 100 # recipients handled by each BroadcastWorker task
+DRAW_PAGE_SIZE = 10 # games drawn by each GenerateAssignmentsWorker request
+EMAIL_RETRY_COUNTDOWN = 60 # seconds before failed recipients are tried again
+MAX_EMAIL_BACKOFF = 60 * 60 # longest wait between tries of a failed email
+FAILED_EMAIL_PAGE_SIZE = 100 # failed emails listed or re-driven per request
+EMAIL_SENDING_TIMEOUT = 60 # seconds a send in progress blocks the same email
+BOARD_DIGEST_WINDOW = 60 * 60 # seconds of message board posts per digest email
+BACKFILL_PAGE_SIZE = 100 # games updated by each backfill task
+DEADLINE_UTC_OFFSET = timedelta(hours=8) # deadlines are in pacific time
+MAX_TASK_ETA = timedelta(days=29) # the taskqueue refuses etas past 30 days
+DRAW_LEASE_TIME = timedelta(minutes=10) # how long a worker may hold a draw
+ROSTER_SHARDS = 16 # RosterShard entities the summary of each game is split over
+
+# Game.draw_status values
+DRAW_PENDING = "pending" # waiting for the signup deadline
+DRAW_DRAWING = "drawing" # a worker holds the lease and is drawing it
+DRAW_DRAWN = "drawn"
+DRAW_FAILED = "failed" # couldn't be drawn, waiting for the creator
+MAX_IMPORT_SIZE = 900000 # bytes of utf-8, has to fit in one entity
+
+def normalize_email(email):
+  """
+  Returns the form of an email address used for duplicate checks
+  """
+  return email.strip().lower()
+
+def email_hash(email):
+  """
+  Returns a short hash of a normalized email for Game.email_hashes
+  """
+  return hashlib.md5(normalize_email(email).encode("utf-8")).hexdigest()[:16]
+
+def parse_invitee_line(line):
+  """
+  Parses one line of a bulk invitee import.  Accepts "email",
+  "name, email", "email, name" and "name <email>".  Returns (email, name)
+  or None if the line doesn't have a valid email on it.
+  """
+  line = line.strip()
+  if not line:
+    return None
+
+  m = re.match(r"^(.*)<([^>]+)>\s*$", line)
+  if m:
+    fields = [m.group(2), m.group(1).strip(' ",')]
+  else:
+    try:
+      fields = csv.reader([line.encode("utf-8")]).next()
+    except csv.Error:
+      # e.g. NUL bytes from a file that wasn't decoded properly
+      return None
+    fields = [x.decode("utf-8") for x in fields]
+
+  email = None
+  name = ""
+  for field in fields:
+    field = field.strip()
+    if not email and "@" in field:
+      email = field
+    elif field and not name:
+      name = field
+
+  if not email or not mail.is_email_valid(email):
+    return None
+  return email, name
+
+def decode_upload(data):
+  """
+  Decodes an uploaded invitee file.  Excel saves "unicode text" as UTF-16
+  with a byte order mark, anything else is taken to be UTF-8.
+  """
+  if data.startswith(codecs.BOM_UTF16_LE) or data.startswith(codecs.BOM_UTF16_BE):
+    return data.decode("utf-16", "replace")
+  if data.startswith(codecs.BOM_UTF8):
+    data = data[len(codecs.BOM_UTF8):]
+  return data.decode("utf-8", "replace")
+
 class Person(db.Model):
   creation_time = db.DateTimeProperty(auto_now_add=True)
   last_modified_time = db.DateTimeProperty(auto_now=True)
@@ -34,6 +124,13 @@ class Person(db.Model):
   responded = db.BooleanProperty(default=False)
   gift_hint = db.StringProperty(default="")
   blacklist = db.ListProperty(db.Key) # list of people they don't want
+  # email every message board post right away instead of in a digest
+  immediate_board_emails = db.BooleanProperty(default=False)
+
+  # denormalized from Game.assignments when the draw is written so one
+  # person's assignment can be found without rebuilding the whole cycle
+  receiver = db.SelfReferenceProperty(collection_name="receiver_index")
+  giver = db.SelfReferenceProperty(collection_name="giver_index")
 
   def __str__(self):
     if not self.name or self.name.isspace():
@@ -55,6 +152,13 @@ class Game(db.Model):
   creator = db.ReferenceProperty(Person)
   invitees = db.ListProperty(db.Key) # list of Persons
   assignments = db.ListProperty(db.Key) # list of Persons in assignment order (objects not keys)
+  assignment_version = db.IntegerProperty(default=0) # bumped on every draw
+  # indexed with signup_deadline so the draw only looks at games needing it
+  draw_status = db.StringProperty(default=DRAW_PENDING,
+                                  choices=[DRAW_PENDING, DRAW_DRAWING,
+                                           DRAW_DRAWN, DRAW_FAILED])
+  draw_lease = db.StringProperty() # token of the worker drawing the game
+  draw_lease_expires = db.DateTimeProperty()
 
   # list of Persons that are participating.  x gives gift to x+1
   signup_deadline = db.DateTimeProperty()
@@ -63,6 +167,297 @@ class Game(db.Model):
   location = db.StringProperty()
   invitation_message = db.TextProperty()
 
+  # the roster summary itself lives in RosterShards, outside the game's
+  # entity group.  kept up to date by update_game_roster()
+  email_hashes = db.TextProperty() # space separated email_hash() of invitees
+
+  def reminder_time(self):
+    """
+    Returns when, in pacific time, invitees who haven't responded are
+    reminded: the start of the signup deadline's day
+    """
+    deadline = self.signup_deadline
+    return datetime(deadline.year, deadline.month, deadline.day)
+
+  def set_email_hashes(self, entries):
+    """
+    Stores the email hashes of entries (Persons or RosterEntries)
+    """
+    self.email_hashes = db.Text(" ".join([email_hash(x.email) for x in entries]))
+
+  def email_hash_set(self):
+    """
+    Returns the set of invitee email hashes, or None if this game
+    predates them
+    """
+    if self.email_hashes is None:
+      return None
+    return set(self.email_hashes.split())
+
+class RosterEntry:
+  """
+  Lightweight stand-in for a Person, built from a RosterShard.  Has
+  just what the templates need to list people.
+  """
+  def __init__(self, key, name, email, signed_up, responded):
+    self.key_str = key
+    self.name = name
+    self.email = email
+    self.signed_up = signed_up
+    self.responded = responded
+
+  def __str__(self):
+    if not self.name or self.name.isspace():
+      return self.email
+    else:
+      return "%s (%s)" % (self.name, self.email)
+
+  def key(self):
+    return db.Key(self.key_str)
+
+class RosterShard(db.Model):
+  """
+  Part of a game's roster summary: the RosterEntry fields of the invitees
+  whose keys hash to this shard.  Shards are keyed "<game key>:<shard>"
+  and kept out of the game's entity group so that responses spread their
+  writes over ROSTER_SHARDS small entities instead of one big Game.
+  """
+  last_modified_time = db.DateTimeProperty(auto_now=True)
+  entries = db.TextProperty() # json of person key -> RosterEntry fields
+
+def roster_shard_key(game_key, shard):
+  return db.Key.from_path("RosterShard", "%s:%d" % (game_key, shard))
+
+def person_shard_key(game_key, person_key):
+  """
+  Returns the key of the RosterShard holding the entry for person_key
+  """
+  digest = hashlib.md5(str(person_key)).hexdigest()
+  return roster_shard_key(game_key, int(digest[:8], 16) % ROSTER_SHARDS)
+
+def load_roster_summary(game_key):
+  """
+  Reads the RosterEntry fields of a game from its shards, keyed by person
+  key string
+  """
+  summary = {}
+  keys = [roster_shard_key(game_key, x) for x in range(ROSTER_SHARDS)]
+  for shard in db.get(keys):
+    if shard and shard.entries:
+      summary.update(simplejson.loads(shard.entries))
+  return summary
+
+def load_roster_entries(game_key):
+  """
+  Returns the summarized RosterEntries of a game keyed by person key
+  string, through the cache.  Invitees that haven't been summarized yet
+  are missing.
+  """
+  entries = {}
+  summary = cache.get_roster_summary(game_key, load_roster_summary)
+  for key_str, fields in summary.items():
+    entries[key_str] = RosterEntry(key_str, *fields)
+  return entries
+
+def sync_roster_entries(game_key, people):
+  """
+  Writes the roster summary entries of people (Persons) with one small
+  transaction per shard they hash to
+  """
+  shards = {}
+  for person in people:
+    shard_key = person_shard_key(game_key, person.key())
+    shards.setdefault(shard_key, []).append(person)
+
+  for shard_key, shard_people in shards.items():
+    def txn():
+      shard = db.get(shard_key) or RosterShard(key=shard_key)
+      entries = {}
+      if shard.entries:
+        entries = simplejson.loads(shard.entries)
+      for person in shard_people:
+        entries[str(person.key())] = [person.name, person.email,
+                                      person.signed_up, person.responded]
+      shard.entries = db.Text(simplejson.dumps(entries))
+      shard.put()
+    db.run_in_transaction(txn)
+  if shards:
+    cache.invalidate_game(game_key)
+
+def try_sync_roster_entries(game_key, people):
+  """
+  Like sync_roster_entries() but only logs failures.  Use it where a
+  stale entry heals later: get_roster_entries() fills in missing entries
+  and put_person() also queues a sync task.
+  """
+  try:
+    sync_roster_entries(game_key, people)
+  except db.Error, e:
+    logging.warning("%s: roster summary not synced: %s" % (game_key, e))
+
+def put_person(person):
+  """
+  Writes a Person whose roster summary fields may have changed.  A task
+  that syncs its summary entry is added in the same transaction, so the
+  summary can't be left stale if the direct sync fails.  The receiver
+  and giver are taken from the stored Person, as a draw may have set
+  them since person was read.
+  """
+  game_key = Person.game.get_value_for_datastore(person)
+  def txn():
+    stored = db.get(person.key())
+    if stored:
+      person.receiver = Person.receiver.get_value_for_datastore(stored)
+      person.giver = Person.giver.get_value_for_datastore(stored)
+    person.put()
+    task = Task(url='/tasks/roster/sync', params={
+        'code': str(game_key),
+        'person_keys': str(person.key())})
+    task.add(transactional=True)
+  db.run_in_transaction(txn)
+  try_sync_roster_entries(game_key, [person])
+
+def update_game_roster(game_key, add=[], remove=[], roster_hashes=None):
+  """
+  Transactionally appends the Persons in add to the game's invitees and
+  drops the keys in remove, keeping the email hashes in step.  People
+  whose email is already in the game are not added, so concurrent adds
+  can't both get in.  roster_hashes stands in for the email hashes of
+  games that predate them.  Then writes the roster summary entries of
+  the added people and returns them.
+  """
+  removed = [x for x in db.get(remove) if x]
+  def txn():
+    game = db.get(game_key)
+    hashes = game.email_hash_set()
+    if hashes is None and roster_hashes is not None:
+      hashes = set(roster_hashes)
+    for key in remove:
+      if key in game.invitees:
+        game.invitees.remove(key)
+    for person in removed:
+      if hashes is not None:
+        hashes.discard(email_hash(person.email))
+    added = []
+    for person in add:
+      if hashes is not None:
+        if email_hash(person.email) in hashes:
+          continue
+        hashes.add(email_hash(person.email))
+      game.invitees.append(person.key())
+      added.append(person)
+    if hashes is not None:
+      game.email_hashes = db.Text(" ".join(hashes))
+    game.put()
+    return added
+
+  added = db.run_in_transaction(txn)
+  rejected = [x.key() for x in add if x not in added]
+  if rejected:
+    logging.info("%s: dropping duplicate invitees %s" % (game_key, rejected))
+    db.delete(rejected)
+  try_sync_roster_entries(game_key, added)
+  cache.invalidate_game(game_key)
+  return added
+
+def set_assignment_index(person_key, receiver_key, giver_key):
+  """
+  Transactionally stores a participant's receiver and giver.  The Person
+  is read again inside the transaction so a response saved meanwhile
+  isn't written over.
+  """
+  def txn():
+    person = db.get(person_key)
+    person.receiver = receiver_key
+    person.giver = giver_key
+    person.put()
+  db.run_in_transaction(txn)
+
+class DrawLeaseHeldError(Exception):
+  def __init__(self, value):
+    self.value = value
+  def __str__(self):
+    return repr(self.value)
+
+class EmailInProgressError(Exception):
+  def __init__(self, value):
+    self.value = value
+  def __str__(self):
+    return repr(self.value)
+
+def claim_draw(game_key):
+  """
+  Transactionally takes the lease on drawing a game so only one worker
+  ever draws it.  Returns the lease token, or None if the game doesn't
+  need a draw any more.  Raises DrawLeaseHeldError while another
+  worker's lease hasn't expired.
+  """
+  token = "%016x" % random.getrandbits(64)
+  def txn():
+    game = db.get(game_key)
+    if game.assignments or game.draw_status in (DRAW_DRAWN, DRAW_FAILED):
+      return None
+    if (game.draw_status == DRAW_DRAWING and
+        game.draw_lease_expires > datetime.utcnow()):
+      raise DrawLeaseHeldError, "%s" % game_key
+    game.draw_status = DRAW_DRAWING
+    game.draw_lease = token
+    game.draw_lease_expires = datetime.utcnow() + DRAW_LEASE_TIME
+    game.put()
+    return token
+
+  token = db.run_in_transaction(txn)
+  cache.invalidate_game(game_key)
+  return token
+
+def finish_draw(game_key, token, assignments):
+  """
+  Stores the assignments if token still holds the game's lease, and in
+  the same transaction queues the task that sends the emails.  Returns
+  the game, or None if the lease was lost.
+  """
+  def txn():
+    game = db.get(game_key)
+    if game.draw_status != DRAW_DRAWING or game.draw_lease != token:
+      return None
+    game.assignments = assignments
+    game.assignment_version += 1
+    game.draw_status = DRAW_DRAWN
+    game.draw_lease = None
+    game.draw_lease_expires = None
+    game.put()
+    task = Task(url='/tasks/draw/fanout', params={
+        'code': str(game_key),
+        'assignment_version': game.assignment_version,
+        })
+    task.add(transactional=True)
+    return game
+
+  game = db.run_in_transaction(txn)
+  cache.invalidate_game(game_key)
+  return game
+
+def fail_draw(game_key, token, task):
+  """
+  Marks the game's draw failed if token still holds its lease, adding
+  task (the notification to the creator) in the same transaction.
+  Returns whether it did.
+  """
+  def txn():
+    game = db.get(game_key)
+    if game.draw_status != DRAW_DRAWING or game.draw_lease != token:
+      return False
+    game.draw_status = DRAW_FAILED
+    game.draw_lease = None
+    game.draw_lease_expires = None
+    game.put()
+    task.add(email_lane(task.url), transactional=True)
+    return True
+
+  failed = db.run_in_transaction(txn)
+  cache.invalidate_game(game_key)
+  return failed
+
 class AnonymousMessage(db.Model):
   creation_time = db.DateTimeProperty(auto_now_add=True)
   last_modified_time = db.DateTimeProperty(auto_now=True)
@@ -82,18 +477,77 @@ class PublicMessage(db.Model):
   sender = db.ReferenceProperty(reference_class=Person, collection_name="public_messages")
   game = db.ReferenceProperty(reference_class=Game, collection_name="public_messages")
 
+class Broadcast(db.Model):
+  """
+  A message going out to many invitees of a game.  The text is stored
+  once here and BroadcastWorker pages through the recipients, so the send
+  tasks only need to carry keys.
+  """
+  creation_time = db.DateTimeProperty(auto_now_add=True)
+  last_modified_time = db.DateTimeProperty(auto_now=True)
+  game = db.ReferenceProperty(reference_class=Game, collection_name="broadcasts")
+  sender = db.ReferenceProperty(reference_class=Person, collection_name="broadcasts")
+  url = db.StringProperty(required=True) # email worker for each recipient
+  subject = db.StringProperty(default="")
+  message = db.TextProperty()
+  signedup_only = db.BooleanProperty(default=False)
+  # only people who want every message board post emailed right away
+  immediate_board_only = db.BooleanProperty(default=False)
+
+class FailedEmail(db.Model):
+  """
+  Dead-letter store for an email task that failed on every attempt it
+  was given.  Holds enough to queue it again once the problem is fixed,
+  see FailedEmailsHandler.
+  """
+  creation_time = db.DateTimeProperty(auto_now_add=True)
+  last_modified_time = db.DateTimeProperty(auto_now=True)
+  url = db.StringProperty(required=True) # email worker the task was for
+  params = db.TextProperty() # json of the task's params
+  error = db.TextProperty()
+  attempts = db.IntegerProperty(default=0)
+  redriven = db.BooleanProperty(default=False)
+
+class InviteeImport(db.Model):
+  """
+  A bulk invitee import.  The pasted or uploaded list is stored once and
+  ImportInviteesWorker works through it a chunk at a time, recording its
+  progress here.
+  """
+  creation_time = db.DateTimeProperty(auto_now_add=True)
+  last_modified_time = db.DateTimeProperty(auto_now=True)
+  game = db.ReferenceProperty(reference_class=Game, collection_name="imports")
+  data = db.TextProperty()
+  offset = db.IntegerProperty(default=0) # where the next unread line starts
+  total = db.IntegerProperty(default=0) # lines in data
+  processed = db.IntegerProperty(default=0)
+  imported = db.IntegerProperty(default=0)
+  skipped = db.IntegerProperty(default=0) # invalid or duplicate lines
+  done = db.BooleanProperty(default=False)
+
 class BaseHandler(webapp.RequestHandler):
   """
   BaseHandler class which all other handlers decend from.
   Implements some commonly useful functions
   """
-  template_values = {
+  default_template_values = {
     "title": "Secret Santa Organizer: Easier than pulling names from a hat.",
     "theme": "ui-lightness",
     "meta_description": "Planning a secret santa? Do it here. Great for co-workers, friends, or family. Easier than pulling names from a hat.  No need to get everyone in the same room.  Names are pulled automatically on the sign-up deadline by computer.  Participants can respond yes or no and provide a gift hint, blacklist others, and send messages.",
     "meta_keywords": "plan planner event gifts gift ideas give online secret santa generator exchange organizer organize organise organiser set up setup create game",
     }
 
+  def initialize(self, request, response):
+    """
+    Called by webapp for every request.  Sets up the request-scoped
+    entity loader so repeated lookups of the same key are only fetched once,
+    and a fresh template context so values never leak between requests
+    """
+    webapp.RequestHandler.initialize(self, request, response)
+    self.loader = EntityLoader()
+    self.template_values = dict(self.default_template_values)
+    self.sends_granted = 0 # sends reserved by acquire_send() not used yet
+
   def webify(self, messages):
     my_messages = []
     for message in messages:
@@ -163,8 +617,7 @@ class BaseHandler(webapp.RequestHandler):
     """
     renders and writes the response given the template name
     """
-    path = os.path.join(os.path.dirname(__file__), template_name)
-    self.response.out.write(template.render(path, self.template_values))
+    self.response.out.write(templates.render(template_name, self.template_values))
 
   def add_flash(self, message):
     """
@@ -253,37 +706,294 @@ class BaseHandler(webapp.RequestHandler):
     Returns if there is another invitee in this game with the
     same email address
     """
-    for invitee_key in game.invitees:
-      invitee = db.get(invitee_key)
-      if invitee.email.lower() == email.lower():
-        self.add_error("%s has already been invited." % email)
-        return True
-    return False
+    hashes = game.email_hash_set()
+    if hashes is None:
+      hashes = set([email_hash(x.email) for x in self.get_roster_entries(game)])
+    duplicate = email_hash(email) in hashes
+
+    if duplicate:
+      self.add_error("%s has already been invited." % email)
+    return duplicate
 
-  # TODO(jesses): consider putting this in a more appropriate class
-  def get_assignment_dict(self, invitee_keys):
+  def get_game(self, game_key):
     """
-    Translates an array of keys that pertain to invitees and
-    translates it into a dictionary of giver -> receiver assignments.
+    Returns the Game for game_key through the read-through cache.  Only use
+    this for reads, handlers that modify the game must db.get() it.
+    """
+    game = cache.get_game(game_key)
+    if game:
+      self.loader.remember([game])
+    return game
 
-    The order of the translation is simply i -> i + 1
+  def get_roster_entries(self, game):
+    """
+    Returns the game's roster as RosterEntry objects in invitee order from
+    the summary shards.  Invitees the summary is missing, as in games
+    that predate it, are read and written back to it.
+    """
+    entries = load_roster_entries(game.key())
+    missing = [x for x in game.invitees if str(x) not in entries]
+    if missing:
+      people = [x for x in self.loader.get_many(missing) if x]
+      for person in people:
+        entries[str(person.key())] = RosterEntry(
+            str(person.key()), person.name, person.email,
+            person.signed_up, person.responded)
+      try_sync_roster_entries(game.key(), people)
+    return [entries[str(x)] for x in game.invitees if str(x) in entries]
+
+  def start_invitee_import(self, game_key, data):
+    """
+    Stores a pasted or uploaded invitee list and queues the worker that
+    imports it.  Returns the InviteeImport.
+    """
+    invitee_import = InviteeImport(game=game_key,
+                                   data=db.Text(data),
+                                   total=len(data.splitlines()))
+    invitee_import.put()
+    task = Task(url='/tasks/import/invitees', params={
+        'import_key': str(invitee_import.key()),
+        })
+    task.add()
+    return invitee_import
 
-    >>> handler = BaseHandler()
-    >>> handler.get_assignment_dict([1, 2, 3])
-    hello
+  def start_broadcast(self, details=(), **fields):
+    """
+    Stores a Broadcast with fields and queues the first BroadcastWorker
+    page for it.  The broadcast is named after its contents, and after
+    details, anything else it announces that isn't in the fields, so the
+    same one started twice within DEDUPE_WINDOW is only sent once.
     """
-    invitee_objs = []
-    for key in invitee_keys:
-      invitee_obj = db.get(key)
-      if invitee_obj.signed_up:
-        invitee_objs.append(invitee_obj)
+    digest_fields = {'details': repr(details)}
+    for key, value in fields.items():
+      if isinstance(value, db.Model):
+        value = value.key()
+      digest_fields[key] = value
+    name = email_task_name('/tasks/broadcast', digest_fields)
+
+    broadcast = Broadcast(key_name=name, **fields)
+    broadcast.put()
+    task = Task(name=name, url='/tasks/broadcast', params={
+        'broadcast_key': str(broadcast.key()),
+        })
+    add_tasks('default', [task])
 
-    assignments = {}
-    if len(invitee_objs) > 0:
-      for i in range(len(invitee_objs) - 1):
-        assignments[invitee_objs[i]] = invitee_objs[i + 1]
-      assignments[invitee_objs[-1]] = invitee_objs[0]
-    return assignments
+  def schedule_board_digest(self, game_key, posted):
+    """
+    Makes sure the message board digest is queued for game_key for the
+    window holding posted, a post's creation time in UTC.  The task is
+    named after the game and window, so a busy board still only gets one
+    digest per window.
+    """
+    window = int(calendar.timegm(posted.utctimetuple()) / BOARD_DIGEST_WINDOW)
+    countdown = (window + 1) * BOARD_DIGEST_WINDOW - time.time()
+    task = Task(name="board-digest-%s-%d" % (game_key, window),
+                url='/tasks/board/digest',
+                params={
+                  'code': str(game_key),
+                  'window': window,
+                  },
+                countdown=max(0, int(countdown)))
+    # does nothing when this window's digest is already on its way
+    add_tasks('default', [task])
+
+  def schedule_deadline_task(self, url, game, when):
+    """
+    Queues a task for url to run for game at when, in pacific time.  The
+    task carries the deadline it was scheduled for, so after the deadline
+    changes the old task finds it's stale and does nothing.
+    """
+    eta = min(when + DEADLINE_UTC_OFFSET, datetime.utcnow() + MAX_TASK_ETA)
+    countdown = eta - datetime.utcnow()
+    task = Task(url=url, params={
+        'code': str(game.key()),
+        'deadline': game.signup_deadline.strftime("%Y-%m-%d %H:%M"),
+        },
+        countdown=max(0, countdown.days * 24 * 60 * 60 + countdown.seconds))
+    task.add()
+
+  def deadline_task_due(self, game, when):
+    """
+    For tasks queued by schedule_deadline_task().  Returns True when the
+    task should do its work now.  Stale tasks get False, and so do ones
+    that woke up early because of the eta limit, after queueing again.
+    """
+    if not game or not game.signup_deadline:
+      return False
+    if self.request.get('deadline') != game.signup_deadline.strftime("%Y-%m-%d %H:%M"):
+      logging.debug("%s: deadline changed, a newer task is queued" % game.key())
+      return False
+    if when + DEADLINE_UTC_OFFSET > datetime.utcnow():
+      # too far out for a single eta, go back to sleep
+      self.schedule_deadline_task(self.request.path, game, when)
+      return False
+    return True
+
+  def schedule_draw(self, game):
+    """
+    Queues the task that draws game at its signup deadline
+    """
+    self.schedule_deadline_task('/tasks/draw/game', game, game.signup_deadline)
+
+  def schedule_reminders(self, game):
+    """
+    Queues the task that reminds invitees on the signup deadline's day,
+    unless that day has already started
+    """
+    if game.reminder_time() + DEADLINE_UTC_OFFSET <= datetime.utcnow():
+      logging.debug("%s: reminder time has passed, not reminding" % game.key())
+      return
+    self.schedule_deadline_task('/tasks/reminders/game', game, game.reminder_time())
+
+  def get_broadcast(self):
+    """
+    Returns the Broadcast named by the broadcast_key param, or None for
+    tasks that carry their message directly
+    """
+    broadcast_key = self.request.get('broadcast_key')
+    if not broadcast_key:
+      return None
+    return self.loader.get(db.Key(broadcast_key))
+
+  def assignment_email_params(self, game, people):
+    """
+    Returns the params of the /tasks/email/assignment tasks for a drawn
+    game, given its participants in assignment order.  Everything the
+    email needs goes in them so the worker doesn't read the datastore.
+    """
+    tasks = []
+    for i in range(len(people)):
+      giver = people[i]
+      receiver = people[(i + 1) % len(people)]
+      tasks.append({
+          'code': str(game.key()),
+          'giver_key': str(giver.key()),
+          'giver_name': giver.name,
+          'giver_email': giver.email,
+          'receiver_key': str(receiver.key()),
+          'receiver_name': receiver.name,
+          'receiver_email': receiver.email,
+          'gift_hint': receiver.gift_hint,
+          'exchange_date': game.exchange_date.strftime("%I:%M%p on %m/%d/%Y"),
+          })
+    return tasks
+
+  def requeue(self, countdown, **overrides):
+    """
+    Queues the current task again with the same params, apart from any
+    given as keyword arguments, to run in countdown seconds
+    """
+    params = {}
+    for key in self.request.arguments():
+      params[key] = self.request.get(key)
+    params.update(overrides)
+    task = Task(url=self.request.path, params=params, countdown=countdown)
+    task.add(self.request.headers.get("X-AppEngine-QueueName", "default"))
+
+  def acquire_send(self, count=1):
+    """
+    Asks the send rate controller for room to send up to count emails
+    and returns how many it granted.  If there isn't room for any the
+    task is queued again for the next minute and 0 is returned, in which
+    case the worker should just stop.
+    """
+    granted = send_rate_controller.acquire(count)
+    if not granted:
+      logging.info("send rate reached, delaying %s" % self.request.path)
+      self.requeue(send_rate_controller.seconds_until_next_minute())
+    self.sends_granted += granted
+    return granted
+
+  def release_sends(self):
+    """
+    Gives the sends reserved by acquire_send() that weren't used back to
+    the send rate controller
+    """
+    if self.sends_granted:
+      send_rate_controller.release(self.sends_granted)
+      self.sends_granted = 0
+
+  def email_sent_key(self, to):
+    """
+    Returns the memcache key marking the current task's email as sent to
+    the address to.  Which batch the recipient was in doesn't matter.
+    """
+    params = {}
+    for key in self.request.arguments():
+      if key not in ("invitee_key", "invitee_keys", "attempt"):
+        params[key] = self.request.get(key)
+    params["to"] = to
+    return "sent:%s:%s" % (self.request.path, params_digest(params))
+
+  def send_email(self, to, subject, html_body):
+    """
+    Sends an html email, recording failures with the send rate controller.
+    An email that was already sent to the same address in the last
+    DEDUPE_WINDOW, by a retried or duplicated task, is dropped.  Raises
+    EmailInProgressError while another task is sending the same email.
+    Uses a send reserved by acquire_send() if there is one, otherwise
+    reserves one and, if the rate is used up, queues the task again
+    without sending.
+    """
+    sent_key = self.email_sent_key(to)
+    if cache.client.get(sent_key):
+      logging.info("%s: already sent to %s, dropping" % (self.request.path, to))
+      return
+    # only marked as sent once it was, a send cut off by the request
+    # deadline just holds the email back for EMAIL_SENDING_TIMEOUT
+    sending_key = "sending:%s" % sent_key
+    if not cache.client.add(sending_key, True, time=EMAIL_SENDING_TIMEOUT):
+      raise EmailInProgressError, "%s to %s" % (self.request.path, to)
+    if not self.sends_granted and not self.acquire_send():
+      cache.client.delete(sending_key)
+      return
+    self.sends_granted -= 1
+    try:
+      mail.send_mail(sender="Secret Santa Organizer <notify@secret-santa-organizer.com>",
+                     to=to,
+                     subject=subject,
+                     body=html_body,
+                     html=html_body)
+    except Exception:
+      send_rate_controller.record_failure()
+      cache.client.delete(sending_key)
+      raise
+    cache.client.set(sent_key, True, time=DEDUPE_WINDOW)
+    cache.client.delete(sending_key)
+
+  def recipient_keys(self):
+    """
+    Returns the keys of everyone an email task is for.  Batched tasks
+    list them in invitee_keys, older ones have a single invitee_key.
+    """
+    keys = self.request.get('invitee_keys') or self.request.get('invitee_key')
+    return [db.Key(x) for x in keys.split(",") if x]
+
+  def get_creator(self, game):
+    """
+    Returns game.creator without a separate fetch when it's already loaded
+    """
+    return self.loader.get(Game.creator.get_value_for_datastore(game))
+
+  def get_assignment_pair(self, game, person):
+    """
+    Returns (receiver, secret_santa) for a participant.  The keys are the
+    ones stored on the Person at draw time.  People drawn before those
+    existed, or before AssignmentFanoutWorker got to them, fall back to
+    the game's cached assignment map.
+    """
+    receiver_key = Person.receiver.get_value_for_datastore(person)
+    giver_key = Person.giver.get_value_for_datastore(person)
+    if (not receiver_key or not giver_key) and game and game.assignments:
+      receivers, givers = cache.get_assignment_map(game)
+      receiver_key = receivers.get(str(person.key()))
+      giver_key = givers.get(str(person.key()))
+
+    if not receiver_key or not giver_key:
+      return None, None
+    receiver, secret_santa = self.loader.get_many([db.Key(str(receiver_key)),
+                                                   db.Key(str(giver_key))])
+    return receiver, secret_santa
 
 class MainHandler(BaseHandler):
   def get(self):
@@ -341,32 +1051,33 @@ class ManageHandler(BaseHandler):
       return
 
     try:
-      game = db.get(db.Key(code))
+      game = self.get_game(db.Key(code))
     except BadKeyError:
       self.add_template_value("error_message", "%s is an invalid code" % code)
       logging.error("invitee_key was missing")
       self.render("error.html")
       return
 
-    assignments = self.get_assignment_dict(game.assignments)
-    invitees = []
-    for invitee_key in game.invitees:
-      invitees.append(db.get(invitee_key))
+    # the whole roster comes from the summary on the game
+    invitees = self.get_roster_entries(game)
+    participants = [x for x in invitees if x.signed_up]
 
-    participants = []
-    invitees_not_participating = []
-    for invitee_keyobj in game.invitees:
-      invitee = db.get(invitee_keyobj)
-      if invitee.signed_up:
-        participants.append(invitee)
-      else:
-        invitees_not_participating.append(invitee)
+    assignments = {}
+    if game.assignments:
+      entries = {}
+      for invitee in invitees:
+        entries[invitee.key_str] = invitee
+      receivers, givers = cache.get_assignment_map(game)
+      for giver_key, receiver_key in receivers.iteritems():
+        if giver_key in entries and receiver_key in entries:
+          assignments[entries[giver_key]] = entries[receiver_key]
 
     public_messages = game.public_messages.order("creation_time")
     logging.debug("public_messages: %s" % [x for x in public_messages])
 
+    self.add_template_value("pending_imports", game.imports.filter("done =", False))
     self.add_template_value("public_messages", self.webify(public_messages))
-    self.add_template_value("creator", game.creator)
+    self.add_template_value("creator", self.get_creator(game))
     self.add_template_value("assignments", assignments)
     self.add_template_value("invitees", invitees)
     self.add_template_value("participants", participants)
@@ -423,16 +1134,17 @@ class SignupHandler(BaseHandler):
       self.render("error.html")
       return
 
-    game = invitee_obj.game
+    game = self.get_game(Person.game.get_value_for_datastore(invitee_obj))
     if not invitee_obj.signed_up and game.assignments:
       self.add_template_value("error_message", "Sorry, the sign-up deadline has already passed.  You can no longer sign up.")
       logging.error("signup deadline passed")
       self.render("error.html")
       return
 
-    invitee_objs = []
-    for invitee_key in game.invitees:
-      invitee_objs.append(db.get(invitee_key))
+    invitee_objs = self.get_roster_entries(game)
+    entries = {}
+    for invitee in invitee_objs:
+      entries[invitee.key_str] = invitee
 
     blacklist = []
     blacklist_options = copy.copy(invitee_objs)
@@ -441,19 +1153,14 @@ class SignupHandler(BaseHandler):
     blacklist_options = self.remove(blacklist_options, invitee_obj.key())
 
     for invitee_key in invitee_obj.blacklist:
-      blacklist.append(db.get(invitee_key))
+      blacklist.append(entries.get(str(invitee_key)) or self.loader.get(invitee_key))
 
       # remove this one from the blacklist_options
       blacklist_options = self.remove(blacklist_options, invitee_key)
 
     assignment = None
     if game.assignments:
-      assignments = self.get_assignment_dict(game.assignments)
-      for giver, receiver in assignments.iteritems():
-        if str(giver.key()) == str(invitee_obj.key()):
-          assignment = receiver
-        if str(receiver.key()) == str(invitee_obj.key()):
-          secret_santa = giver
+      assignment, secret_santa = self.get_assignment_pair(game, invitee_obj)
 
       gift_hint = assignment.gift_hint
       gift_hint = self.html_escape(gift_hint)
@@ -478,8 +1185,7 @@ class SignupHandler(BaseHandler):
     participants = []
     invitees_not_participating = []
     invitees_not_responded = []
-    for invitee_keyobj in game.invitees:
-      invitee = db.get(invitee_keyobj)
+    for invitee in invitee_objs:
       if invitee.signed_up:
         participants.append(invitee)
         continue
@@ -511,10 +1217,9 @@ class SignupHandler(BaseHandler):
 class CreationEmailHandler(BaseHandler):
   def post(self):
     code = self.request.get("code")
-    task = Task(url='/tasks/email/creation', params={
+    queue_email('/tasks/email/creation', {
         'code': code,
         })
-    task.add('email-throttle')
 
     self.response.headers["Content-Type"] = "text/plain"
     self.response.out.write("OK")
@@ -524,11 +1229,10 @@ class InvitationEmailHandler(BaseHandler):
     invitee_key = self.request.get('invitee_key')
     code = self.request.get('code')
 
-    task = Task(url='/tasks/email/invitation', params={
+    queue_email('/tasks/email/invitation', {
         'code': code,
         'invitee_key': invitee_key,
         })
-    task.add('email-throttle')
 
     self.response.headers["Content-Type"] = "text/plain"
     self.response.out.write("OK")
@@ -550,23 +1254,16 @@ class MessageEmailHandler(BaseHandler):
       self.redirect("/signup?invitee_key=%s" % invitee_key)
       return
 
-    task = Task(url='/tasks/email/message', params={
+    queue_email('/tasks/email/message', {
         'invitee_key': invitee_key,
         'to_secret_santa': to_secret_santa,
         'message': message,
         'code': code,
         })
-    task.add('email-throttle')
-
-    game = db.get(db.Key(code))
 
-    assignments = self.get_assignment_dict(game.assignments)
+    game = self.get_game(db.Key(code))
 
-    for giver, receiver in assignments.iteritems():
-      if str(giver.key()) == invitee_key:
-        my_assignment = receiver
-      elif str(receiver.key()) == invitee_key:
-        my_secret_santa = giver
+    my_assignment, my_secret_santa = self.get_assignment_pair(game, invitee_obj)
 
     if to_secret_santa:
       recipient = my_secret_santa
@@ -592,17 +1289,6 @@ class PostPublicMessageHandler(BaseHandler):
     code = self.request.get('code')
 
     game = db.get(db.Key(code))
-    for invitee_key in game.invitees:
-      if str(invitee_key) == str(sender_key):
-        continue
-      task = Task(url='/tasks/email/public_message', params={
-          'invitee_key': invitee_key,
-          'sender_key': sender_key,
-          'message': message,
-          'code': code,
-          })
-      task.add('email-throttle')
-
     sender_obj = db.get(db.Key(sender_key))
 
     public_message = PublicMessage(
@@ -611,6 +1297,14 @@ class PostPublicMessageHandler(BaseHandler):
       game=game)
     public_message.put()
 
+    # everyone else hears about it in the next digest
+    self.start_broadcast(game=game,
+                         sender=sender_obj,
+                         url='/tasks/email/public_message',
+                         message=message,
+                         immediate_board_only=True)
+    self.schedule_board_digest(game.key(), public_message.creation_time)
+
     self.add_flash("Message Posted.")
     self.redirect("/signup?invitee_key=%s" % sender_key)
     logging.debug("Exiting PostPublicMessageHandler post()")
@@ -620,11 +1314,10 @@ class AssignmentEmailHandler(BaseHandler):
     giver_key = self.request.get('giver_key')
     code = self.request.get('code')
 
-    task = Task(url='/tasks/email/assignment', params={
+    queue_email('/tasks/email/assignment', {
         'code': code,
         'giver_key': giver_key,
         })
-    task.add('email-throttle')
 
     self.response.headers["Content-Type"] = "text/plain"
     self.response.out.write("OK")
@@ -635,26 +1328,105 @@ class NotificationEmailHandler(BaseHandler):
     code = self.request.get('code')
     signedup_only = self.request.get('signedup_only')
 
-    game = db.get(db.Key(code))
-
-    for invitee_key in game.invitees:
-      invitee_obj = db.get(invitee_key)
-      if signedup_only and not invitee_obj.signed_up:
-        # not signed up
-        continue
-
-      task = Task(url='/tasks/email/notification', params={
-          'code': code,
-          'invitee_key': str(invitee_key),
-          'message': message,
-          'subject': "Notification about your Secret Santa Gift Exchange",
-          })
-      task.add('email-throttle')
+    self.start_broadcast(game=db.Key(code),
+                         url='/tasks/email/notification',
+                         subject="Notification about your Secret Santa Gift Exchange",
+                         message=message,
+                         signedup_only=bool(signedup_only))
 
     self.response.headers["Content-Type"] = "text/plain"
     self.response.out.write("OK")
 
-class CreationEmailWorker(BaseHandler):
+class EmailWorker(BaseHandler):
+  """
+  Base class for the /tasks/email/* workers.  A failing email is retried
+  with exponential backoff up to email_retry_limit() attempts and then
+  stored as a FailedEmail, so it can't keep competing with healthy mail.
+  """
+  def attempt(self):
+    """
+    Returns how many times this email was tried before, counting both
+    queue retries and batches of failed recipients queued again
+    """
+    retries = self.request.headers.get("X-AppEngine-TaskRetryCount") or 0
+    return int(self.request.get("attempt") or 0) + int(retries)
+
+  def last_attempt(self):
+    return self.attempt() + 1 >= email_retry_limit(self.request.path)
+
+  def dead_letter(self, error, **overrides):
+    """
+    Stores the current task as a FailedEmail, with any params given as
+    keyword arguments replaced
+    """
+    params = {}
+    for key in self.request.arguments():
+      if key != "attempt":
+        params[key] = self.request.get(key)
+    params.update(overrides)
+    FailedEmail(url=self.request.path,
+                params=db.Text(simplejson.dumps(params)),
+                error=db.Text("%s: %s" % (error.__class__.__name__, error)),
+                attempts=self.attempt() + 1).put()
+
+  def handle_exception(self, exception, debug_mode):
+    """
+    Called by webapp when the worker raises.  Fails the task so the queue
+    retries it with backoff, unless this was its last attempt.
+    """
+    if not self.last_attempt():
+      BaseHandler.handle_exception(self, exception, debug_mode)
+      return
+    logging.exception("%s: giving up after %d attempts" % (self.request.path,
+                                                          self.attempt() + 1))
+    self.dead_letter(exception)
+
+  def send_to_recipients(self, send_one):
+    """
+    Calls send_one(invitee) for as many recipients of the current task as
+    the send rate controller has room for, and queues the rest again for
+    the next minute.  Anyone whose email fails is queued again in a new
+    batch of their own, after a backoff, or stored as a FailedEmail on
+    the last attempt.
+    """
+    keys = self.recipient_keys()
+    if not keys:
+      return
+    granted = self.acquire_send(len(keys))
+    if not granted:
+      return
+    if granted < len(keys):
+      logging.info("send rate reached, delaying %d recipients of %s" %
+                   (len(keys) - granted, self.request.path))
+      self.requeue(send_rate_controller.seconds_until_next_minute(),
+                   invitee_keys=",".join([str(x) for x in keys[granted:]]))
+      keys = keys[:granted]
+
+    failed = []
+    for key, invitee_obj in zip(keys, self.loader.get_many(keys)):
+      if not invitee_obj:
+        logging.info("%s: recipient %s no longer exists" % (self.request.path, key))
+        continue
+      try:
+        send_one(invitee_obj)
+      except Exception, e:
+        logging.error("%s: sending to %s failed: %s" % (self.request.path, key, e))
+        failed.append((str(key), e))
+    # recipients that were skipped don't count against the rate
+    self.release_sends()
+
+    if not failed:
+      return
+    if self.last_attempt():
+      for key, error in failed:
+        self.dead_letter(error, invitee_keys=key)
+      return
+    attempt = self.attempt() + 1
+    countdown = min(MAX_EMAIL_BACKOFF, EMAIL_RETRY_COUNTDOWN * 2 ** (attempt - 1))
+    self.requeue(countdown, attempt=attempt,
+                 invitee_keys=",".join([key for key, error in failed]))
+
+class CreationEmailWorker(EmailWorker):
   def post(self):
       code = self.request.get('code')
       game = db.get(db.Key(code))
@@ -665,23 +1437,13 @@ class CreationEmailWorker(BaseHandler):
       self.add_template_value("signup_deadline",
                               game.signup_deadline.strftime("%m/%d/%Y"))
 
-      html_body = template.render(os.path.join(os.path.dirname(__file__),
-                                               "creation_email.html"),
-                                  self.template_values)
-      mail.send_mail(sender="Secret Santa Organizer <notify@secret-santa-organizer.com>",
-                     to=creator_obj.email,
-                     subject="Your Secret Santa Gift Exchange",
-                     body=html_body,
-                     html=html_body)
+      html_body = templates.render("creation_email.html", self.template_values)
+      self.send_email(creator_obj.email, "Your Secret Santa Gift Exchange", html_body)
 
-class InvitationEmailWorker(BaseHandler):
+class InvitationEmailWorker(EmailWorker):
   def post(self):
-    invitee_key = self.request.get('invitee_key')
     code = self.request.get('code')
-
-    game = db.get(db.Key(code))
-
-    invitee_obj = db.get(db.Key(invitee_key))
+    game = self.get_game(db.Key(code))
 
     self.add_template_value("price", game.price)
     self.add_template_value("signup_deadline",
@@ -690,36 +1452,26 @@ class InvitationEmailWorker(BaseHandler):
                             game.exchange_date.strftime("%m/%d/%Y %I:%M%p"))
     self.add_template_value("location", game.location)
     self.add_template_value("invitation_message", game.invitation_message)
-    self.add_template_value("invitee", invitee_obj)
-    self.add_template_value("creator", game.creator)
-    html_body = template.render(os.path.join(os.path.dirname(__file__),
-                                             "invitation_email.html"),
-                                self.template_values)
-    mail.send_mail(sender="Secret Santa Organizer <notify@secret-santa-organizer.com>",
-                   to=invitee_obj.email,
-                   subject="Your Secret Santa Invitation",
-                   body=html_body,
-                   html=html_body)
-
-class MessageEmailWorker(BaseHandler):
+    self.add_template_value("creator", self.get_creator(game))
+
+    def send_one(invitee_obj):
+      self.add_template_value("invitee", invitee_obj)
+      html_body = templates.render("invitation_email.html", self.template_values)
+      self.send_email(invitee_obj.email, "Your Secret Santa Invitation", html_body)
+    self.send_to_recipients(send_one)
+
+class MessageEmailWorker(EmailWorker):
   def post(self):
     logging.debug("Entering MessageEmailWorker post()")
-
     invitee_key = self.request.get('invitee_key')
     to_secret_santa = self.request.get('to_secret_santa')
     message = self.request.get('message')
     code = self.request.get('code')
 
     invitee_obj = db.get(db.Key(invitee_key))
-    game = db.get(db.Key(code))
-
-    assignments = self.get_assignment_dict(game.assignments)
+    game = self.get_game(db.Key(code))
 
-    for giver, receiver in assignments.iteritems():
-      if str(giver.key()) == invitee_key:
-        my_assignment = receiver
-      elif str(receiver.key()) == invitee_key:
-        my_secret_santa = giver
+    my_assignment, my_secret_santa = self.get_assignment_pair(game, invitee_obj)
 
     if to_secret_santa:
       recipient = my_secret_santa
@@ -735,74 +1487,84 @@ class MessageEmailWorker(BaseHandler):
     self.add_template_value("sender", sender)
     self.add_template_value("non_sender", non_sender)
     self.add_template_value("recipient", recipient)
-    html_body = template.render(os.path.join(os.path.dirname(__file__),
-                                             "message_email.html"),
-                                self.template_values)
-    mail.send_mail(sender="Secret Santa Organizer <notify@secret-santa-organizer.com>",
-                   to=recipient.email,
-                   subject="Message from %s" % sender,
-                   body=html_body,
-                   html=html_body)
+    html_body = templates.render("message_email.html", self.template_values)
+    self.send_email(recipient.email, "Message from %s" % sender, html_body)
 
     logging.debug("Exiting MessageEmailWorker post()")
 
-class PublicMessageEmailWorker(BaseHandler):
+class PublicMessageEmailWorker(EmailWorker):
   def post(self):
     logging.debug("Entering PublicMessageEmailWorker post()")
-
     sender_key = self.request.get('sender_key')
-    invitee_key = self.request.get('invitee_key')
     message = self.request.get('message')
     code = self.request.get('code')
 
-    sender_obj = db.get(db.Key(sender_key))
-    invitee_obj = db.get(db.Key(invitee_key))
-    game = db.get(db.Key(code))
+    broadcast = self.get_broadcast()
+    if broadcast:
+      sender_key = str(Broadcast.sender.get_value_for_datastore(broadcast))
+      message = broadcast.message
 
+    sender_obj = self.loader.get(db.Key(sender_key))
     self.add_template_value("message", message)
     self.add_template_value("sender", sender_obj)
-    self.add_template_value("recipient", invitee_obj)
-    html_body = template.render(os.path.join(os.path.dirname(__file__),
-                                             "public_message_email.html"),
-                                self.template_values)
-    mail.send_mail(sender="Secret Santa Organizer <notify@secret-santa-organizer.com>",
-                   to=invitee_obj.email,
-                   subject="Post to Message Board from %s" % sender_obj,
-                   body=html_body,
-                   html=html_body)
+
+    def send_one(invitee_obj):
+      self.add_template_value("recipient", invitee_obj)
+      html_body = templates.render("public_message_email.html", self.template_values)
+      self.send_email(invitee_obj.email, "Post to Message Board from %s" % sender_obj, html_body)
+    self.send_to_recipients(send_one)
 
     logging.debug("Exiting PublicMessageEmailWorker post()")
 
-class ReminderEmailWorker(BaseHandler):
+class BoardDigestEmailWorker(EmailWorker):
+  def post(self):
+    """
+    Sends a digest of message board posts to everyone in the batch who
+    didn't already get each post emailed to them, or write them all
+    """
+    broadcast = self.get_broadcast()
+    posts = simplejson.loads(broadcast.message)
+    self.add_template_value("posts", posts)
+    sender_keys = set([x.get("sender_key") for x in posts])
+    body = templates.render_shared("board_digest_email.html",
+                                   self.template_values, "recipient",
+                                   str(broadcast.key()))
+
+    def send_one(invitee_obj):
+      if invitee_obj.immediate_board_emails:
+        return
+      if sender_keys == set([str(invitee_obj.key())]):
+        return
+      html_body = templates.personalize(body, invitee_obj)
+      self.send_email(invitee_obj.email, broadcast.subject, html_body)
+    self.send_to_recipients(send_one)
+
+class ReminderEmailWorker(EmailWorker):
   def post(self):
-    invitee_key = self.request.get('invitee_key')
     subject = self.request.get('subject')
-    code = self.request.get('code')
 
-    game = db.get(db.Key(code))
+    # the reminder is the same for everyone apart from who it's to
+    body = templates.render_shared("reminder_email.html", self.template_values,
+                                   "invitee", "reminder")
 
-    invitee_obj = db.get(db.Key(invitee_key))
-    self.add_template_value("invitee", invitee_obj)
-    html_body = template.render(os.path.join(os.path.dirname(__file__),
-                                             "reminder_email.html"),
-                                self.template_values)
-    mail.send_mail(sender="Secret Santa Organizer <notify@secret-santa-organizer.com>",
-                   to=invitee_obj.email,
-                   subject=subject,
-                   body=html_body,
-                   html=html_body)
-
-class NotificationEmailWorker(BaseHandler):
+    def send_one(invitee_obj):
+      html_body = templates.personalize(body, invitee_obj)
+      self.send_email(invitee_obj.email, subject, html_body)
+    self.send_to_recipients(send_one)
+
+class NotificationEmailWorker(EmailWorker):
   def post(self):
-    invitee_key = self.request.get('invitee_key')
     message = self.request.get('message')
     subject = self.request.get('subject')
     code = self.request.get('code')
     show_manage_button = self.request.get('show_manage_button')
 
-    game = db.get(db.Key(code))
+    broadcast = self.get_broadcast()
+    if broadcast:
+      message = broadcast.message
+      subject = broadcast.subject
 
-    invitee_obj = db.get(db.Key(invitee_key))
+    game = self.get_game(db.Key(code))
 
     self.add_template_value("price", game.price)
     self.add_template_value("signup_deadline",
@@ -811,110 +1573,233 @@ class NotificationEmailWorker(BaseHandler):
                             game.exchange_date.strftime("%m/%d/%Y %I:%M%p"))
     self.add_template_value("location", game.location)
     self.add_template_value("message", urllib.unquote(message))
-    self.add_template_value("invitee", invitee_obj)
-    self.add_template_value("creator", game.creator)
+    self.add_template_value("creator", self.get_creator(game))
     self.add_template_value("show_manage_button", show_manage_button)
     self.add_template_value("code", code)
-    html_body = template.render(os.path.join(os.path.dirname(__file__),
-                                             "notification_email.html"),
-                                self.template_values)
-    mail.send_mail(sender="Secret Santa Organizer <notify@secret-santa-organizer.com>",
-                   to=invitee_obj.email,
-                   subject=subject,
-                   body=html_body,
-                   html=html_body)
-
-class AssignmentEmailWorker(BaseHandler):
+
+    if broadcast:
+      # render the broadcast once and only fill in who it's to per email
+      body = templates.render_shared("notification_email.html",
+                                     self.template_values, "invitee",
+                                     str(broadcast.key()))
+
+    def send_one(invitee_obj):
+      if broadcast:
+        html_body = templates.personalize(body, invitee_obj)
+      else:
+        self.add_template_value("invitee", invitee_obj)
+        html_body = templates.render("notification_email.html", self.template_values)
+      self.send_email(invitee_obj.email, subject, html_body)
+    self.send_to_recipients(send_one)
+
+class AssignmentEmailWorker(EmailWorker):
   def post(self):
     giver_key = self.request.get('giver_key')
     code = self.request.get('code')
 
-    game = db.get(db.Key(code))
+    if self.request.get('receiver_email'):
+      # precomputed at draw time, no datastore reads needed
+      giver_obj = RosterEntry(giver_key,
+                              self.request.get('giver_name'),
+                              self.request.get('giver_email'),
+                              True, True)
+      receiver_obj = RosterEntry(self.request.get('receiver_key'),
+                                 self.request.get('receiver_name'),
+                                 self.request.get('receiver_email'),
+                                 True, True)
+      gift_hint = self.request.get('gift_hint')
+      exchange_date = self.request.get('exchange_date')
+    else:
+      game = self.get_game(db.Key(code))
 
-    assignments = self.get_assignment_dict(game.assignments)
+      giver_obj = self.loader.get(db.Key(giver_key))
+      receiver_obj = None
+      if giver_obj:
+        receiver_obj, secret_santa = self.get_assignment_pair(game, giver_obj)
 
-    giver_obj = None
-    receiver_obj = None
-    for giver, receiver in assignments.iteritems():
-      if str(giver.key()) == giver_key:
-        giver_obj = giver
-        receiver_obj = receiver
+      if not giver_obj or not receiver_obj:
+        logging.error("giver_key: %s" % giver_key)
+        logging.error("code: %s" % code)
+        logging.error("assignments: %s" % game.assignments)
+        self.error(500)
 
-    if not giver_obj or not receiver_obj:
-      logging.error("giver_key: %s" % giver_key)
-      logging.error("code: %s" % code)
-      logging.error("assignments: %s" % assignments)
-      self.error(500)
+      gift_hint = receiver_obj.gift_hint
+      exchange_date = game.exchange_date.strftime("%I:%M%p on %m/%d/%Y")
 
     self.add_template_value("giver", giver_obj)
     self.add_template_value("receiver", receiver_obj)
-    self.add_template_value("gift_hint", receiver_obj.gift_hint)
-    self.add_template_value("exchange_date",
-                            game.exchange_date.strftime("%I:%M%p on %m/%d/%Y"))
-    html_body = template.render(os.path.join(os.path.dirname(__file__),
-                                             "assignment_email.html"),
-                                self.template_values)
-    mail.send_mail(sender="Secret Santa Organizer <notify@secret-santa-organizer.com>",
-                   to=giver_obj.email,
-                   subject="Your Secret Santa Assignment",
-                   body=html_body,
-                   html=html_body)
-
-class EmailRemindersWorker(BaseHandler):
-  """
-  Send out a reminder of the signup deadline 1 day beforehand
-  """
-  def get(self):
-    # no need to convert this to PST because we really only care about days
-    # not hours.  UTC will be in the same day as PST assuming this is run at
-    # 00:00 PST.  UTC should be 8:00 PST
-    now = datetime.now()
-
-    one_day = timedelta(days=1)
-    today = datetime.today()
-    today_elapsed = timedelta(hours=today.hour,
-                              minutes=today.minute,
-                              seconds=today.second,
-                              microseconds=today.microsecond)
-    today = today - today_elapsed
-    tomorrow = today + one_day
-    logging.debug("today: %s" % today)
-    logging.debug("tomorrow: %s" % tomorrow)
+    self.add_template_value("gift_hint", gift_hint)
+    self.add_template_value("exchange_date", exchange_date)
+    html_body = templates.render("assignment_email.html", self.template_values)
+    self.send_email(giver_obj.email, "Your Secret Santa Assignment", html_body)
+
+class RosterSyncWorker(BaseHandler):
+  def post(self):
+    """
+    Brings the roster summary entries of some people up to date with
+    their Persons.  Added by put_person() in the transaction that wrote
+    them, so failures are retried by the queue.
+    """
+    keys = [db.Key(x) for x in self.request.get('person_keys').split(",") if x]
+    people = [x for x in db.get(keys) if x]
+    sync_roster_entries(db.Key(self.request.get('code')), people)
 
-    games = Game.all().filter("signup_deadline >=", today).filter("signup_deadline <", tomorrow)
-    logging.debug([x.signup_deadline for x in games])
+class GameRemindersWorker(BaseHandler):
+  def post(self):
+    """
+    Reminds everyone in a game who hasn't responded yet that the signup
+    deadline is today, and tells the creator
+    """
+    game = self.get_game(db.Key(self.request.get('code')))
+    if not self.deadline_task_due(game, game and game.reminder_time()):
+      return
+    if game.assignments:
+      logging.debug("%s: assignments already generated, skipping" % game.key())
+      return
 
-    for game in games:
-      if not game.signup_deadline:
-        # no signup deadline.. either an old entry or some kind of error. skip
-        logging.debug("%s: no signup deadline, skipping" & game.key())
-        continue
+    # the roster summary says who has responded without reading anyone
+    tasks = TaskBuffer(send_rate_controller.batch_size())
+    for entry in self.get_roster_entries(game):
+      if not entry.responded:
+        tasks.add_for_game(game.key(), '/tasks/email/reminder', {
+            'code': str(game.key()),
+            'invitee_key': entry.key_str,
+            'subject': "Secret Santa Reminder: 1 Day Left to Respond",
+            })
 
-      logging.debug(game.signup_deadline)
-      if game.assignments:
-        logging.debug("%s: assignments already generated, skipping" & game.key())
+    # send the creator a reminder email too
+    tasks.add_for_game(game.key(), '/tasks/email/notification', {
+        'code': str(game.key()),
+        'invitee_key': str(Game.creator.get_value_for_datastore(game)),
+        'show_manage_button': "True",
+        'subject': 'Secret Santa Reminder: 1 Day Left',
+        'message': "This is a reminder that there is only one day left for participants to respond yes or no to the invitation.  An email reminder was sent to people who didn't respond, but you may want to give them an extra nudge.  Click below to see who has signed up.",
+        })
+    tasks.flush()
+
+class BroadcastWorker(BaseHandler):
+  def post(self):
+    """
+    Queues the send tasks for one page of a broadcast's recipients, then
+    queues itself again with a cursor for the next page
+    """
+    broadcast = self.get_broadcast()
+    game_key = Broadcast.game.get_value_for_datastore(broadcast)
+    sender_key = Broadcast.sender.get_value_for_datastore(broadcast)
+    game = self.get_game(game_key)
+    invitees = set(game.invitees) # people removed from the game still refer to it
+
+    query = Person.all(keys_only=True).filter("game =", game_key)
+    if broadcast.signedup_only:
+      query.filter("signed_up =", True)
+    if broadcast.immediate_board_only:
+      query.filter("immediate_board_emails =", True)
+    cursor = self.request.get('cursor')
+    if cursor:
+      query.with_cursor(cursor)
+    page = query.fetch(BROADCAST_PAGE_SIZE)
+
+    tasks = TaskBuffer(send_rate_controller.batch_size())
+    for invitee_key in page:
+      if invitee_key not in invitees or invitee_key == sender_key:
         continue
+      tasks.add_for_game(game_key, broadcast.url, {
+          'code': str(game_key),
+          'invitee_key': str(invitee_key),
+          'broadcast_key': str(broadcast.key()),
+          })
+    tasks.flush()
 
-      for invitee_key in game.invitees:
-        invitee_obj = db.get(invitee_key)
-        if not invitee_obj.signed_up:
-          task = Task(url='/tasks/email/reminder', params={
-              'code': str(game.key()),
-              'invitee_key': str(invitee_key),
-              'subject': "Secret Santa Reminder: 1 Day Left to Respond",
-              })
-          task.add('email-throttle')
-
-      # send the creator a reminder email too
-      game.creator
-      task = Task(url='/tasks/email/notification', params={
-          'code': str(game.key()),
-          'invitee_key': str(game.creator.key()),
-          'show_manage_button': "True",
-          'subject': 'Secret Santa Reminder: 1 Day Left',
-          'message': "This is a reminder that there is only one day left for participants to respond yes or no to the invitation.  An email reminder was sent to people who didn't sign up, but you may want to give them an extra nudge.  Click below to see who has signed up.",
+    if len(page) == BROADCAST_PAGE_SIZE:
+      task = Task(url='/tasks/broadcast', params={
+          'broadcast_key': str(broadcast.key()),
+          'cursor': query.cursor(),
           })
-      task.add('email-throttle')
+      task.add()
+
+class BoardDigestWorker(BaseHandler):
+  def post(self):
+    """
+    Gathers a game's message board posts from one digest window and
+    broadcasts them in a single email per invitee
+    """
+    game_key = db.Key(self.request.get('code'))
+    window = int(self.request.get('window'))
+    start = datetime.utcfromtimestamp(window * BOARD_DIGEST_WINDOW)
+    end = datetime.utcfromtimestamp((window + 1) * BOARD_DIGEST_WINDOW)
+
+    messages = PublicMessage.all().filter("game =", game_key)
+    messages.filter("creation_time >=", start).filter("creation_time <", end)
+    messages = messages.order("creation_time").fetch(1000)
+    if not messages:
+      return
+
+    sender_keys = [PublicMessage.sender.get_value_for_datastore(x)
+                   for x in messages]
+    senders = self.loader.get_many(sender_keys)
+    posts = []
+    for message, sender_key, sender in zip(messages, sender_keys, senders):
+      posts.append({"sender": unicode(sender),
+                    "sender_key": str(sender_key),
+                    "message": message.message})
+
+    self.start_broadcast(game=game_key,
+                         url='/tasks/email/board_digest',
+                         subject="New Posts to Your Secret Santa Message Board",
+                         message=simplejson.dumps(posts))
+
+class FailedEmailsHandler(BaseHandler):
+  def get(self):
+    """
+    Lists the most recent failed emails that haven't been re-driven as json
+    """
+    failed = FailedEmail.all().filter("redriven =", False)
+    failed = failed.order("-creation_time").fetch(FAILED_EMAIL_PAGE_SIZE)
+    self.response.headers["Content-Type"] = "application/json"
+    self.response.out.write(simplejson.dumps([{
+        "key": str(x.key()),
+        "creation_time": x.creation_time.strftime("%Y-%m-%d %H:%M:%S"),
+        "url": x.url,
+        "params": simplejson.loads(x.params),
+        "error": x.error,
+        "attempts": x.attempts,
+        } for x in failed]))
+
+  def post(self):
+    """
+    Queues failed emails again and marks them re-driven: the ones listed
+    in keys, or else the most recent FAILED_EMAIL_PAGE_SIZE.  Post again
+    until the count comes back 0.
+    """
+    keys = self.request.get("keys")
+    if keys:
+      failed = db.get([db.Key(x) for x in keys.split(",") if x])
+      failed = [x for x in failed if x and not x.redriven]
+    else:
+      failed = FailedEmail.all().filter("redriven =", False)
+      failed = failed.order("-creation_time").fetch(FAILED_EMAIL_PAGE_SIZE)
+
+    tasks = TaskBuffer()
+    for x in failed:
+      params = {}
+      for key, value in simplejson.loads(x.params).items():
+        params[str(key)] = value
+      # unnamed, a dedupe name from the first time may still be taken
+      tasks.add(Task(url=x.url, params=params))
+      x.redriven = True
+    tasks.flush()
+    db.put(failed)
+
+    self.response.headers["Content-Type"] = "application/json"
+    self.response.out.write(simplejson.dumps({"redriven": len(failed)}))
+
+class EmailMetricsHandler(BaseHandler):
+  def get(self):
+    """
+    Reports the send rate controller's state as json
+    """
+    self.response.headers["Content-Type"] = "application/json"
+    self.response.out.write(simplejson.dumps(send_rate_controller.metrics()))
 
 class AssignmentsNotPossibleError(Exception):
   def __init__(self, value):
@@ -922,12 +1807,15 @@ class AssignmentsNotPossibleError(Exception):
   def __str__(self):
     return repr(self.value)
 
-class GenerateAssignmentsWorker(BaseHandler):
+class AssignmentDrawer:
+  """
+  Mixin for the handlers that draw games
+  """
   def random_assignments(self, list):
     logging.debug("Entering random_assignments")
     while True:
       try:
-        g = BlacklistGraph(list)
+        g = BlacklistGraph(list, self.loader)
         logging.debug("Graph: %s" % g)
         cycle = g.random_cycle()
         logging.debug("cycle found:")
@@ -940,8 +1828,7 @@ class GenerateAssignmentsWorker(BaseHandler):
         logging.debug("no cycle found")
         # remove a random blacklist entry until there are none left
         blacklist_found = False
-        for participant in list:
-          participant = db.get(participant)
+        for participant in self.loader.get_many(list):
           if participant.blacklist:
             blacklist_found = True
         if not blacklist_found:
@@ -950,8 +1837,7 @@ class GenerateAssignmentsWorker(BaseHandler):
 
         # blacklists still exist, remove a random one
         random_list = randomize_list(list)
-        for participant in random_list:
-          participant = db.get(participant)
+        for participant in self.loader.get_many(random_list):
           if participant.blacklist:
             # remove first element after randomizing
             participant.blacklist = randomize_list(participant.blacklist)
@@ -963,74 +1849,225 @@ class GenerateAssignmentsWorker(BaseHandler):
         # continue with the infinite loop
     logging.debug("Exiting generate_assignments: this should never happen")
 
+  def draw_game(self, game):
+    """
+    Generates the assignments for one game whose deadline has passed and
+    queues the assignment emails, or tells the creator it wasn't possible
+    """
+    if not game.signup_deadline:
+      # no signup deadline.. either an old entry or some kind of error. skip
+      logging.debug("%s: no signup_deadline, skipping" % game.key())
+      return
+
+    if game.assignments:
+      # already generated, just make sure it isn't picked up again
+      logging.debug("%s: already generated, skipping" % game.key())
+      if game.draw_status != DRAW_DRAWN:
+        game.draw_status = DRAW_DRAWN
+        game.put()
+        cache.invalidate_game(game.key())
+      return
+
+    logging.debug("signup deadline: %s" % game.signup_deadline)
+
+    # only the worker holding the lease does any drawing
+    token = claim_draw(game.key())
+    if not token:
+      logging.debug("%s: already drawn by another worker" % game.key())
+      return
+
+    # these are the games that we should generate assignments for
+    # convert to objs
+    participants = []
+    for invitee in self.loader.get_many(game.invitees):
+      if invitee.signed_up:
+        participants.append(invitee.key())
+
+    logging.debug("participants for %s: %s" % (game.key(), participants))
+    try:
+      participants = self.random_assignments(participants)
+      # the emails are queued with the assignments, see AssignmentFanoutWorker
+      if not finish_draw(game.key(), token, participants):
+        logging.warning("%s: lost the draw lease, discarding" % game.key())
+    except AssignmentsNotPossibleError:
+      logging.debug("Assignments not possible error")
+      # stays failed until the creator changes the details
+      task = Task(url='/tasks/email/notification', params={
+          'code': str(game.key()),
+          'invitee_key': str(Game.creator.get_value_for_datastore(game)),
+          'show_manage_button': "True",
+          'subject': 'Problem with your Secret Santa Gift Exchange',
+          'message': "Assignments could not be generated. There probably weren't enough people signed up.  Try extending the sign-up deadline and sending out a reminder to sign up.",
+          })
+      if not fail_draw(game.key(), token, task):
+        logging.warning("%s: lost the draw lease, discarding" % game.key())
+
+class GenerateAssignmentsWorker(AssignmentDrawer, BaseHandler):
   def get(self):
+    """
+    Called by cron.  Only queues the first page of a run over the games
+    whose deadlines passed in the last five days: cron requests aren't
+    retried, tasks are.
+    """
     logging.debug("Entering GenerateAssignmentsWorker get()")
 
     # no need to convert this to PST because we really only care about days
     # not hours.  UTC will be in the same day as PST assuming this is run at
     # 00:00 PST.  UTC should be 8:00 PST
-    now = datetime.now()
-
-    five_days = timedelta(days=5)
-    today = datetime.today()
-    today_elapsed = timedelta(hours=today.hour,
-                              minutes=today.minute,
-                              seconds=today.second,
-                              microseconds=today.microsecond)
-    today = today - today_elapsed
-    five_days_ago = today - five_days
+    today = datetime.today().strftime("%Y-%m-%d")
+    # named so a repeated cron request doesn't start a second run
+    task = Task(name="draw-run-%s" % today,
+                url='/tasks/generate/assignments',
+                params={'today': today})
+    add_tasks('default', [task])
+    logging.debug("Exiting GenerateAssignmentsWorker get()")
+
+  def post(self):
+    """
+    Draws a page of a run, continuing from the cursor left by the
+    previous page.  The day the run started on is passed along so every
+    page uses the same window.  The first page also picks up draws whose
+    worker died holding the lease.
+    """
+    today = datetime.strptime(self.request.get('today'), "%Y-%m-%d")
+    cursor = self.request.get('cursor')
+    if not cursor:
+      query = Game.all(keys_only=True).filter("draw_status =", DRAW_DRAWING)
+      query.filter("draw_lease_expires <", datetime.utcnow())
+      for game in self.loader.get_many(query.fetch(DRAW_PAGE_SIZE)):
+        try:
+          self.draw_game(game)
+        except Exception:
+          logging.exception("%s: draw failed" % game.key())
+    self.draw_page(today, cursor)
+
+  def draw_page(self, today, cursor):
+    """
+    Draws the next DRAW_PAGE_SIZE games after cursor, then queues a task
+    to carry on from where this page stopped.  A page that fails is
+    retried from the same cursor and skips the games it already drew.
+    """
+    five_days_ago = today - timedelta(days=5)
     logging.debug("five_days_ago: %s" % five_days_ago)
     logging.debug("today: %s" % today)
 
-    # go through all the games in the database
-    # find the ones that have deadlines since five_days_ago
-    # generate the assignments, and send emails
-    games = Game.all().filter("signup_deadline <", today).filter("signup_deadline >=", five_days_ago)
+    # find the games still waiting for a draw that have deadlines since
+    # five_days_ago, generate the assignments, and send emails
+    query = Game.all(keys_only=True).filter("draw_status =", DRAW_PENDING)
+    query.filter("signup_deadline <", today).filter("signup_deadline >=", five_days_ago)
+    if cursor:
+      query.with_cursor(cursor)
+    keys = query.fetch(DRAW_PAGE_SIZE)
+    games = [x for x in self.loader.get_many(keys) if x]
     logging.debug("signup_deadlines: %s" % [x.signup_deadline for x in games])
 
     for game in games:
-      if not game.signup_deadline:
-        # no signup deadline.. either an old entry or some kind of error. skip
-        logging.debug("%s: no signup_deadline, skipping" % game.key())
-        continue
+      try:
+        self.draw_game(game)
+      except Exception:
+        # don't let one bad game hold up the rest of the run, tomorrow's
+        # run will try it again
+        logging.exception("%s: draw failed" % game.key())
+
+    if len(keys) == DRAW_PAGE_SIZE:
+      task = Task(url='/tasks/generate/assignments', params={
+          'today': today.strftime("%Y-%m-%d"),
+          'cursor': query.cursor(),
+          })
+      task.add()
 
-      if game.assignments:
-        # already generated, skip
-        logging.debug("%s: already generated, skipping" % game.key())
-        continue
+class DrawGameWorker(AssignmentDrawer, BaseHandler):
+  def post(self):
+    """
+    Draws a single game at its signup deadline.  The daily cron still
+    sweeps up any game whose task was lost.
+    """
+    game = db.get(db.Key(self.request.get('code')))
+    if not self.deadline_task_due(game, game and game.signup_deadline):
+      return
+    if game.draw_status not in (DRAW_PENDING, DRAW_DRAWING):
+      logging.debug("%s: draw status is %s, skipping" % (game.key(), game.draw_status))
+      return
+    # a DrawLeaseHeldError fails the task, so it's retried once the
+    # current lease expires in case its worker died
+    self.draw_game(game)
 
-      logging.debug("signup deadline: %s" % game.signup_deadline)
+class AssignmentFanoutWorker(BaseHandler):
+  def post(self):
+    """
+    Queued in the same transaction that stores a draw.  Stores each
+    participant's receiver and giver with them and sends the emails.
+    """
+    game = db.get(db.Key(self.request.get('code')))
+    if game.assignment_version != int(self.request.get('assignment_version')):
+      logging.debug("%s: drawn again since, skipping" % game.key())
+      return
 
-      # these are the games that we should generate assignments for
-      # convert to objs
-      participants = []
-      for invitee_key in game.invitees:
-        if db.get(invitee_key).signed_up:
-          participants.append(invitee_key)
+    # store each participant's receiver and giver with them so
+    # lookups don't need to rebuild the whole cycle.  people already
+    # done by an earlier try of this task are skipped
+    people = self.loader.get_many(game.assignments)
+    for i in range(len(people)):
+      receiver_key = people[(i + 1) % len(people)].key()
+      giver_key = people[i - 1].key()
+      if (Person.receiver.get_value_for_datastore(people[i]) != receiver_key or
+          Person.giver.get_value_for_datastore(people[i]) != giver_key):
+        set_assignment_index(people[i].key(), receiver_key, giver_key)
+    cache.invalidate_game(game.key())
 
-      logging.debug("participants for %s: %s" % (game.key(), participants))
-      try:
-        participants = self.random_assignments(participants)
-        game.assignments = participants
-        game.put()
+    # send emails
+    tasks = TaskBuffer()
+    for params in self.assignment_email_params(game, people):
+      tasks.add_for_game(game.key(), '/tasks/email/assignment', params)
+    tasks.flush()
 
-        # send emails
-        for giver_key in game.assignments:
-          task = Task(url='/tasks/email/assignment', params={
-              'giver_key': giver_key,
-              'code': str(game.key())})
-          task.add('email-throttle')
-      except AssignmentsNotPossibleError:
-        logging.debug("Assignments not possible error")
-        task = Task(url='/tasks/email/notification', params={
-            'code': str(game.key()),
-            'invitee_key': str(game.creator.key()),
-            'show_manage_button': "True",
-            'subject': 'Problem with your Secret Santa Gift Exchange',
-            'message': "Assignments could not be generated. There probably weren't enough people signed up.  Try extending the sign-up deadline and sending out a reminder to sign up.",
-            })
-        task.add('email-throttle')
-    logging.debug("Exiting GenerateAssignmentsWorker get()")
+class DrawStatusBackfillWorker(BaseHandler):
+  """
+  Sets draw_status on games created before it existed, which the draw
+  query can't see until they have one, and queues the draw and reminder
+  tasks for the ones still to come
+  """
+  def get(self):
+    self.backfill_page(None)
+    self.response.headers["Content-Type"] = "text/plain"
+    self.response.out.write("OK")
+
+  def post(self):
+    self.backfill_page(self.request.get('cursor'))
+
+  def backfill_page(self, cursor):
+    query = Game.all()
+    if cursor:
+      query.with_cursor(cursor)
+    games = query.fetch(BACKFILL_PAGE_SIZE)
+
+    # old games load with the default status but aren't in the index until
+    # they're written again, so write everything.  failed games are new
+    # enough to already be indexed
+    changed = []
+    for game in games:
+      if game.draw_status == DRAW_FAILED:
+        continue
+      if game.assignments:
+        game.draw_status = DRAW_DRAWN
+      else:
+        game.draw_status = DRAW_PENDING
+      changed.append(game)
+    if changed:
+      db.put(changed)
+      for game in changed:
+        cache.invalidate_game(game.key())
+        if game.draw_status != DRAW_PENDING or not game.signup_deadline:
+          continue
+        if game.signup_deadline + DEADLINE_UTC_OFFSET > datetime.utcnow():
+          self.schedule_draw(game)
+        self.schedule_reminders(game)
+
+    if len(games) == BACKFILL_PAGE_SIZE:
+      task = Task(url='/tasks/backfill/draw_status', params={
+          'cursor': query.cursor(),
+          })
+      task.add()
 
 class ResendAssignmentsHandler(BaseHandler):
   def get(self):
@@ -1041,12 +2078,11 @@ class ResendAssignmentsHandler(BaseHandler):
     logging.debug('code: %s' % code)
     logging.debug('assignments: %s' % game.assignments)
     # send emails
-    for giver_key in game.assignments:
-      logging.debug('giver_key: %s' % giver_key)
-      task = Task(url='/tasks/email/assignment', params={
-              'giver_key': giver_key,
-              'code': str(game.key())})
-      task.add('email-throttle')
+    tasks = TaskBuffer()
+    people = self.loader.get_many(game.assignments)
+    for params in self.assignment_email_params(game, people):
+      tasks.add_for_game(game.key(), '/tasks/email/assignment', params)
+    tasks.flush()
     
     logging.debug("Exiting ResendAssignments get()")
     self.response.headers["Content-Type"] = "text/plain"
@@ -1073,6 +2109,7 @@ class CreateHandler(BaseHandler):
     location = self.request.get("location")
     price = self.request.get("price")
     is_creator_participating = self.request.get("is_creator_participating", "True")
+    bulk_invitees = self.request.get("bulk_invitees")
 
     if not creator_email or creator_email.isspace():
       self.add_error("You must specify an email for the organizer.")
@@ -1100,28 +2137,22 @@ class CreateHandler(BaseHandler):
       self.redirect("/")
       return
 
+    if len(bulk_invitees.encode("utf-8")) > MAX_IMPORT_SIZE:
+      self.add_error("That list of invitees is too long.  Try splitting it up.")
+      self.redirect("/")
+      return
+
     logging.debug(exchange_date)
     is_creator_participating = (is_creator_participating == "True")
 
-    # it sucks that we have to put() this, but we need the key() to initialize
-    # the Person objects.  when there is an error, we have to delete() the
-    # game
-    game = Game()
-    game.put()
-
-    creator = Person(email=creator_email,
-                     name=creator_name,
-                     game=game)
-
+    # everything is validated in memory first, then the game, creator and
+    # invitees are written together with pre-allocated keys.  nothing is
+    # stored if the request is rejected
     invitees = {}
 
     # array of invitees (don't forget to add the creator)
     if is_creator_participating:
-      invitees[0] = creator
-    else:
-      # normally, it would get "put" along with the invitees, now it doesn't
-      # so we must do it as a one-off
-      creator.put()
+      invitees[0] = {"email": creator_email, "name": creator_name}
 
     # invitee post parameter regular expression
     invitee_email_re = re.compile(r"invitee(\d+)_email")
@@ -1143,73 +2174,96 @@ class CreateHandler(BaseHandler):
       if len(value) == 0:
         continue
 
-      try:
-        invitee = invitees[id]
-        # entry exists, move on
-      except KeyError:
-        # entry missing, create
-        invitee = Person(email="required",
-                         game=game)
-        invitees[id] = invitee
-
+      # entry missing, create
+      invitee = invitees.setdefault(id, {"email": "required", "name": ""})
       if email_match:
-        invitees[id].email = value
+        invitee["email"] = value
       if name_match:
-        invitees[id].name = value
+        invitee["name"] = value
 
     # convert invitees from dictionary to array
-    new_invitees = []
-    for key, value in invitees.items():
-      new_invitees.append(value)
-    invitees = new_invitees
+    ids = invitees.keys()
+    ids.sort()
+    invitees = [invitees[x] for x in ids]
 
     # check for duplicates, reject if found
     # skip item 0 because that's the creator.  it's okay for them to have
     # duplicates since that's a ui problem
-    for i in range(1, len(invitees)):
-      for j in range(i + 1, len(invitees)):
-        if invitees[j].email.lower() == invitees[i].email.lower():
-          # duplicate found
-          game.delete()
-          self.add_error("Looks like you entered %s more than once.  Try again." % invitees[j].email)
-          self.redirect("/")
-          return
+    seen = set()
+    for invitee in invitees[1:]:
+      if normalize_email(invitee["email"]) in seen:
+        # duplicate found
+        self.add_error("Looks like you entered %s more than once.  Try again." % invitee["email"])
+        self.redirect("/")
+        return
+      seen.add(normalize_email(invitee["email"]))
 
     # remove duplicates of the creator
     r = range(1, len(invitees))
     r.reverse()
     for i in r:
-      if invitees[i].email.lower() == creator.email.lower():
-        logging.debug("removing %s from invitee list because he/she is the creator", invitees[i])
+      if normalize_email(invitees[i]["email"]) == normalize_email(creator_email):
+        logging.debug("removing %s from invitee list because he/she is the creator", invitees[i]["email"])
         invitees.pop(i)
 
-    invitee_keys = []
-    for invitee in invitees:
-      invitee.put()
-      invitee_keys.append(invitee.key())
-
-    # insert game into datastore
-    game.creator = creator
-    game.invitees = invitee_keys
-    game.price = price
-    game.location = location
-    game.exchange_date = exchange_date
-    game.signup_deadline = signup_deadline
-    game.invitation_message = db.Text(invitation_message)
-    game.put()
+    # the creator is the first invitee when participating, otherwise they
+    # need a key of their own
+    person_keys = allocate_keys(Person, len(invitees) + (not is_creator_participating))
+    game_key = allocate_keys(Game, 1)[0]
+    try:
+      people = [Person(key=person_keys[i],
+                       game=game_key,
+                       email=invitees[i]["email"],
+                       name=invitees[i]["name"])
+                for i in range(len(invitees))]
+    except db.BadValueError, e:
+      self.add_error("Looks like one of the emails is invalid: %s" % e)
+      self.redirect("/")
+      return
 
-    # send creator email through email-throttle queue
+    if is_creator_participating:
+      creator = people[0]
+      invitees = people
+    else:
+      creator = Person(key=person_keys[-1],
+                       game=game_key,
+                       email=creator_email,
+                       name=creator_name)
+      invitees = people
+      people = people + [creator]
+
+    game = Game(key=game_key,
+                creator=creator.key(),
+                invitees=[x.key() for x in invitees],
+                price=price,
+                location=location,
+                exchange_date=exchange_date,
+                signup_deadline=signup_deadline,
+                invitation_message=db.Text(invitation_message))
+    game.set_email_hashes(invitees)
+
+    # the game goes last so it only becomes visible once everyone exists
+    put_batched(people + [game])
+    try_sync_roster_entries(game.key(), invitees)
+    self.schedule_draw(game)
+    self.schedule_reminders(game)
+
+    # send creator email and invitations through the critical email lane
     code = urllib.quote(str(game.key()))
-    task = Task(url='/tasks/email/creation', params={
-        'code': code})
-    task.add('email-throttle')
+    tasks = TaskBuffer(send_rate_controller.batch_size())
+    tasks.add(email_task('/tasks/email/creation', {
+        'code': code}))
 
     # send invitations
     for invitee_key in game.invitees:
-      task = Task(url='/tasks/email/invitation', params={
+      tasks.add_for_game(game.key(), '/tasks/email/invitation', {
           'invitee_key': str(invitee_key),
           'code': code})
-      task.add('email-throttle')
+    tasks.flush()
+
+    # the pasted list goes through the same import as an existing game
+    if bulk_invitees and not bulk_invitees.isspace():
+      self.start_invitee_import(game.key(), bulk_invitees)
 
     self.add_flash("Event was created successfully.  Invitations have been sent.")
     self.add_extra_data("from_create")
@@ -1251,26 +2305,39 @@ class SaveDetailsHandler(BaseHandler):
       self.redirect("/manage?code=%s" % code)
       return
 
-    game = db.get(db.Key(code))
-    game.price = price
-    game.location = location
-    game.signup_deadline = signup_deadline
-    game.exchange_date = exchange_date
-    game.put()
+    # in a transaction so a draw finishing meanwhile isn't written over
+    def txn():
+      game = db.get(db.Key(code))
+      deadline_changed = game.signup_deadline != signup_deadline
+      redraw = deadline_changed or game.draw_status == DRAW_FAILED
+      game.price = price
+      game.location = location
+      game.signup_deadline = signup_deadline
+      game.exchange_date = exchange_date
+      if not game.assignments and game.draw_status == DRAW_FAILED:
+        # a failed draw gets another try at the new deadline.  a draw in
+        # progress is left alone, resetting it would void its lease
+        game.draw_status = DRAW_PENDING
+      game.put()
+      return game, deadline_changed, redraw
+    game, deadline_changed, redraw = db.run_in_transaction(txn)
+    if not game.assignments and redraw:
+      self.schedule_draw(game)
+    if not game.assignments and deadline_changed:
+      self.schedule_reminders(game)
+    cache.invalidate_game(game.key())
 
     message = "Some event dates or details have been modified."
     if edit_details_message:
       message = message + "<br><br>Message from the creator:<br>\"%s\"" % edit_details_message
 
     if send_edit_details_message:
-      for invitee_key in game.invitees:
-        task = Task(url='/tasks/email/notification', params={
-            'code': code,
-            'invitee_key': str(invitee_key),
-            'subject': 'Updates to Your Secret Santa Gift Exchange',
-            'message': message,
-            })
-        task.add('email-throttle')
+      self.start_broadcast(game=game,
+                           url='/tasks/email/notification',
+                           subject='Updates to Your Secret Santa Gift Exchange',
+                           message=message,
+                           details=(game.price, game.location,
+                                    game.signup_deadline, game.exchange_date))
       self.add_flash("Details were saved successfully. Update Messages Sent.")
     else:
       self.add_flash("Details were saved successfully.")
@@ -1284,9 +2351,7 @@ class RemoveInviteeHandler(BaseHandler):
     code = self.request.get("code")
     invitee_key = self.request.get("invitee_key")
 
-    game = db.get(db.Key(code))
-    game.invitees.remove(db.Key(invitee_key))
-    game.put()
+    update_game_roster(db.Key(code), remove=[db.Key(invitee_key)])
 
     self.redirect("/manage?code=%s" % code)
 
@@ -1302,6 +2367,8 @@ class RespondHandler(BaseHandler):
     continue_url = self.request.get("continue_url")
     name = self.request.get("name")
     gift_hint = self.request.get("gift_hint")
+    board_email_settings = self.request.get("board_email_settings")
+    immediate_board_emails = self.request.get("immediate_board_emails")
     blacklist = self.get_new_blacklist_from_request()
 
     participant = db.get(db.Key(participant_key))
@@ -1316,7 +2383,10 @@ class RespondHandler(BaseHandler):
       participant.gift_hint = gift_hint
     if blacklist:
       participant.blacklist = blacklist
-    participant.put()
+    if board_email_settings:
+      # unchecked boxes aren't posted, so the form marks that it had one
+      participant.immediate_board_emails = bool(immediate_board_emails)
+    put_person(participant)
 
     if participant.signed_up:
       if by_manager:
@@ -1348,29 +2418,147 @@ class AddInviteeHandler(BaseHandler):
       invitee = Person(email=invitee_email,
                        game=game)
       invitee.put()
-      game.invitees.append(invitee.key())
-      game.put()
-
-      task = Task(url='/tasks/email/invitation', params={
-          'code': code,
-          'invitee_key': str(invitee.key()),
-          })
-      task.add('email-throttle')
-      self.add_flash("Invitation sent to %s" % invitee)
+      roster_hashes = None
+      if game.email_hashes is None:
+        roster_hashes = [email_hash(x.email) for x in self.get_roster_entries(game)]
+      if update_game_roster(game.key(), add=[invitee],
+                            roster_hashes=roster_hashes):
+        queue_email('/tasks/email/invitation', {
+            'code': code,
+            'invitee_key': str(invitee.key()),
+            })
+        self.add_flash("Invitation sent to %s" % invitee)
+      else:
+        # another request added the same email first
+        self.add_error("%s has already been invited." % invitee_email)
 
     if continue_url:
       self.redirect(continue_url)
     else:
       self.redirect("/manage?code=%s" % code)
 
+class ImportInviteesHandler(BaseHandler):
+  def post(self):
+    """
+    Starts a bulk import of a pasted list and/or uploaded csv of invitees
+    """
+    code = self.request.get("code")
+    continue_url = self.request.get("continue_url") or "/manage?code=%s" % code
+
+    data = self.request.get("invitees")
+    uploaded = self.request.get("invitees_file")
+    if uploaded:
+      if not isinstance(uploaded, unicode):
+        uploaded = decode_upload(uploaded)
+      data = data + "\n" + uploaded
+
+    if not data or data.isspace():
+      self.add_error("Paste some invitees or choose a file to import.")
+    elif len(data.encode("utf-8")) > MAX_IMPORT_SIZE:
+      self.add_error("That list of invitees is too long.  Try splitting it up.")
+    else:
+      invitee_import = self.start_invitee_import(db.Key(code), data)
+      self.add_flash("Importing %d lines.  Invitations will go out as they're added." % invitee_import.total)
+
+    self.redirect(continue_url)
+
+class ImportStatusHandler(BaseHandler):
+  def get(self):
+    """
+    Reports the progress of a bulk import as json
+    """
+    invitee_import = db.get(db.Key(self.request.get("import_key")))
+    self.response.headers["Content-Type"] = "application/json"
+    self.response.out.write(simplejson.dumps({
+        "total": invitee_import.total,
+        "processed": invitee_import.processed,
+        "imported": invitee_import.imported,
+        "skipped": invitee_import.skipped,
+        "done": invitee_import.done,
+        }))
+
+class ImportInviteesWorker(BaseHandler):
+  def post(self):
+    """
+    Imports the next chunk of lines of a bulk import, then queues itself
+    again until the whole list is done
+    """
+    invitee_import = db.get(db.Key(self.request.get("import_key")))
+    if not invitee_import or invitee_import.done:
+      return
+
+    game = db.get(InviteeImport.game.get_value_for_datastore(invitee_import))
+    roster_hashes = [email_hash(x.email) for x in self.get_roster_entries(game)]
+    hashes = set(roster_hashes)
+    hashes.add(email_hash(self.get_creator(game).email))
+
+    # read the next chunk of lines
+    data = invitee_import.data
+    offset = invitee_import.offset
+    lines = []
+    while offset < len(data) and len(lines) < IMPORT_CHUNK_SIZE:
+      end = data.find("\n", offset)
+      if end == -1:
+        end = len(data)
+      lines.append(data[offset:end])
+      offset = end + 1
+
+    # normalize and dedupe in one pass, against the game and the list itself
+    new_invitees = []
+    for line in lines:
+      if not line.strip():
+        continue
+      parsed = parse_invitee_line(line)
+      if not parsed or email_hash(parsed[0]) in hashes:
+        invitee_import.skipped += 1
+        continue
+      hashes.add(email_hash(parsed[0]))
+      new_invitees.append(parsed)
+
+    keys = allocate_keys(Person, len(new_invitees))
+    people = [Person(key=keys[i],
+                     game=game.key(),
+                     email=new_invitees[i][0],
+                     name=new_invitees[i][1])
+              for i in range(len(new_invitees))]
+    if people:
+      put_batched(people)
+      people = update_game_roster(game.key(), add=people,
+                                  roster_hashes=roster_hashes)
+      invitee_import.skipped += len(new_invitees) - len(people)
+
+    tasks = TaskBuffer(send_rate_controller.batch_size())
+    for invitee in people:
+      tasks.add_for_game(game.key(), '/tasks/email/invitation', {
+          'invitee_key': str(invitee.key()),
+          'code': str(game.key())})
+    tasks.flush()
+
+    invitee_import.offset = offset
+    invitee_import.processed += len(lines)
+    invitee_import.imported += len(people)
+    invitee_import.done = offset >= len(data)
+    invitee_import.put()
+
+    if not invitee_import.done:
+      task = Task(url='/tasks/import/invitees', params={
+          'import_key': str(invitee_import.key()),
+          })
+      task.add()
+
 class SaveInvitationMessageHandler(BaseHandler):
   def post(self):
     code = urllib.unquote(self.request.get("code"))
     invitation_message = urllib.unquote(self.request.get("invitation_message"))
 
-    game = db.get(db.Key(code))
-    game.invitation_message = db.Text(invitation_message)
-    game.put()
+    # in a transaction so a draw finishing meanwhile isn't written over
+    def txn():
+      game = db.get(db.Key(code))
+      game.invitation_message = db.Text(invitation_message)
+      game.put()
+      return game
+    game = db.run_in_transaction(txn)
+    cache.invalidate_game(game.key())
 
     self.response.headers["Content-Type"] = "text/plain"
     self.response.out.write("OK")
@@ -1423,6 +2611,8 @@ def main():
                                         ("/save/details", SaveDetailsHandler),
                                         ("/remove/invitee", RemoveInviteeHandler),
                                         ("/add/invitee", AddInviteeHandler),
+                                        ("/import/invitees", ImportInviteesHandler),
+                                        ("/import/status", ImportStatusHandler),
 
                                         # asyncs
                                         ("/save/invitation_message", SaveInvitationMessageHandler),
@@ -1443,10 +2633,20 @@ def main():
                                         ("/tasks/email/creation", CreationEmailWorker),
                                         ("/tasks/email/reminder", ReminderEmailWorker),
                                         ("/tasks/email/public_message", PublicMessageEmailWorker),
+                                        ("/tasks/email/board_digest", BoardDigestEmailWorker),
+                                        ("/tasks/board/digest", BoardDigestWorker),
+                                        ("/tasks/import/invitees", ImportInviteesWorker),
+                                        ("/tasks/broadcast", BroadcastWorker),
+                                        ("/tasks/email/metrics", EmailMetricsHandler),
+                                        ("/tasks/email/failed", FailedEmailsHandler),
 
                                         # cron jobs
                                         ("/tasks/generate/assignments", GenerateAssignmentsWorker),
-                                        ("/tasks/email/reminders", EmailRemindersWorker),
+                                        ("/tasks/backfill/draw_status", DrawStatusBackfillWorker),
+                                        ("/tasks/draw/game", DrawGameWorker),
+                                        ("/tasks/draw/fanout", AssignmentFanoutWorker),
+                                        ("/tasks/reminders/game", GameRemindersWorker),
+                                        ("/tasks/roster/sync", RosterSyncWorker),
                                         ],
                                        debug=True)
   wsgiref.handlers.CGIHandler().run(application)
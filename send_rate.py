@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# author: Jesse Shieh (jesse.shieh@gmail.com)
+#
+# Adaptive, quota-aware send rate for the email workers.  Sends and
+# failures are counted per minute in memcache.  The allowed rate creeps
+# up while sends succeed and are using the capacity, halves when sends
+# start failing.  Sends may burst at that rate while most of the daily
+# mail quota is left, and are slowed toward MIN_RATE only as the day's
+# total nears the quota.
+
+import time
+import cache
+
+DAILY_QUOTA = 2000 # recipients per day, keep in line with the app's quota
+START_RATE = 32 # emails per minute
+MIN_RATE = 2
+MAX_RATE = 240
+RATE_STEP = 4 # added after each busy minute without failures
+FAILURE_RATIO = 0.1 # back off when more than this share of sends fail
+MAX_BATCH_SIZE = 50 # most recipients a worker task should handle
+QUOTA_RESET_OFFSET = 8 * 60 * 60 # quota resets at midnight pacific, UTC-8
+QUOTA_RESERVE = 0.1 # share of the quota over which sending is slowed down
+
+COUNTER_TIMEOUT = 10 * 60 # seconds
+DAY_TIMEOUT = 25 * 60 * 60 # seconds
+
+class SendRateController:
+  def __init__(self, client=None):
+    self.client = client or cache.client
+
+  def now(self):
+    return time.time()
+
+  def minute(self, offset=0):
+    return int(self.now() / 60) + offset
+
+  def day(self):
+    return int((self.now() - QUOTA_RESET_OFFSET) / (24 * 60 * 60))
+
+  def minutes_left_today(self):
+    seconds = (self.day() + 1) * 24 * 60 * 60 + QUOTA_RESET_OFFSET - self.now()
+    return max(1, int(seconds / 60))
+
+  def counter(self, name, period):
+    return self.client.get("sendrate:%s:%d" % (name, period)) or 0
+
+  def increment(self, name, period, delta, timeout=COUNTER_TIMEOUT):
+    key = "sendrate:%s:%d" % (name, period)
+    self.client.add(key, 0, time=timeout)
+    return self.client.incr(key, delta=delta) or 0
+
+  def adaptive_rate(self):
+    """
+    Returns the rate learned from recent sends, ignoring the quota
+    """
+    return self.client.get("sendrate:rate") or START_RATE
+
+  def quota_rate(self):
+    """
+    Returns the most that today's remaining quota allows per minute.
+    Until only QUOTA_RESERVE of the quota is left that is all of it;
+    after that it shrinks toward MIN_RATE, but never below the rate that
+    would spread what's left over the rest of the day.
+    """
+    remaining = DAILY_QUOTA - self.counter("day", self.day())
+    reserve = DAILY_QUOTA * QUOTA_RESERVE
+    if remaining >= reserve:
+      return remaining
+    scaled = MIN_RATE + (MAX_RATE - MIN_RATE) * remaining / reserve
+    spread = float(remaining) / self.minutes_left_today()
+    return max(0, min(remaining, max(scaled, spread)))
+
+  def rate(self):
+    """
+    Returns how many emails may be sent this minute
+    """
+    self.adjust()
+    return self.current_rate()
+
+  def current_rate(self):
+    """
+    Like rate() but without adjusting the adaptive rate first
+    """
+    if self.counter("day", self.day()) >= DAILY_QUOTA:
+      return 0
+    return int(max(MIN_RATE, min(self.adaptive_rate(), self.quota_rate())))
+
+  def batch_size(self, rate=None):
+    """
+    Returns how many recipients each worker task should take on, so task
+    dispatch keeps up with rate, by default the current rate
+    """
+    if rate is None:
+      rate = self.rate()
+    return max(1, min(MAX_BATCH_SIZE, rate / 8))
+
+  def adjust(self):
+    """
+    Updates the adaptive rate from the last full minute.  Only the first
+    caller in each minute does any work.
+    """
+    if not self.client.add("sendrate:adjusted:%d" % self.minute(),
+                           True, time=COUNTER_TIMEOUT):
+      return
+    rate = self.adaptive_rate()
+    sent = self.counter("sent", self.minute(-1))
+    failed = self.counter("failed", self.minute(-1))
+    if sent and float(failed) / sent > FAILURE_RATIO:
+      rate = max(MIN_RATE, rate / 2)
+    elif sent >= rate * 0.8:
+      rate = min(MAX_RATE, rate + RATE_STEP)
+    self.client.set("sendrate:rate", rate)
+
+  def acquire(self, count=1):
+    """
+    Reserves up to count sends in the current minute, as many as the
+    current rate leaves room for.  Returns how many were reserved.
+    """
+    rate = self.rate()
+    sent = self.increment("sent", self.minute(), count)
+    granted = max(0, min(count, rate - (sent - count)))
+    if granted < count:
+      self.client.decr("sendrate:sent:%d" % self.minute(), delta=count - granted)
+    if granted:
+      self.increment("day", self.day(), granted, timeout=DAY_TIMEOUT)
+    return granted
+
+  def release(self, count):
+    """
+    Gives back count sends reserved by acquire() that weren't made
+    """
+    self.client.decr("sendrate:sent:%d" % self.minute(), delta=count)
+    self.client.decr("sendrate:day:%d" % self.day(), delta=count)
+
+  def record_failure(self, count=1):
+    self.increment("failed", self.minute(), count)
+
+  def seconds_until_next_minute(self):
+    return 60 - int(self.now()) % 60
+
+  def metrics(self):
+    """
+    Returns the controller's current state for monitoring, without
+    changing it
+    """
+    rate = self.current_rate()
+    return {
+      "rate": rate,
+      "adaptive_rate": self.adaptive_rate(),
+      "quota_rate": self.quota_rate(),
+      "batch_size": self.batch_size(rate),
+      "sent_this_minute": self.counter("sent", self.minute()),
+      "failed_this_minute": self.counter("failed", self.minute()),
+      "sent_last_minute": self.counter("sent", self.minute(-1)),
+      "failed_last_minute": self.counter("failed", self.minute(-1)),
+      "sent_today": self.counter("day", self.day()),
+      "daily_quota": DAILY_QUOTA,
+      }
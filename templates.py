@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# author: Jesse Shieh (jesse.shieh@gmail.com)
+#
+# Registry of compiled django templates.  Each template is loaded and
+# parsed once per instance and kept for the life of the process, so a
+# render only costs the render itself.
+#
+# Emails that go to many people with the same content are rendered once
+# with placeholders standing in for the recipient, cached, and then
+# personalized with a plain string substitution per recipient.
+
+import os
+import cache
+from google.appengine.ext.webapp import template
+from django.template import Context
+
+TEMPLATE_DIR = os.path.dirname(__file__)
+SHARED_BODY_TIMEOUT = 60 * 60 # seconds
+
+# stand-ins for the recipient in shared bodies, never valid in real values
+RECIPIENT_NAME = "%%RECIPIENT_NAME%%"
+RECIPIENT_KEY = "%%RECIPIENT_KEY%%"
+
+compiled = {} # template name -> compiled template
+shared_bodies = cache.LRUCache(max_size=50, ttl=SHARED_BODY_TIMEOUT)
+
+def get_template(name):
+  """
+  Returns the compiled template for name, loading it on first use
+  """
+  compiled_template = compiled.get(name)
+  if compiled_template is None:
+    compiled_template = template.load(os.path.join(TEMPLATE_DIR, name))
+    compiled[name] = compiled_template
+  return compiled_template
+
+def render(name, values):
+  """
+  Renders the template called name with the dictionary values
+  """
+  return get_template(name).render(Context(values))
+
+class RecipientPlaceholder:
+  """
+  Takes the place of the recipient while rendering a shared body.  Only
+  supports what the email templates use: printing it and its key.
+  """
+  def __str__(self):
+    return RECIPIENT_NAME
+
+  def key(self):
+    return RECIPIENT_KEY
+
+def render_shared(name, values, recipient_field, cache_key):
+  """
+  Returns the body of template name rendered with values, and with the
+  recipient_field left as placeholders for personalize() to fill in.
+  The body is cached under cache_key, which must change whenever any of
+  the values do.
+  """
+  key = "shared_body:%s:%s:%s" % (os.environ.get("CURRENT_VERSION_ID"),
+                                  name, cache_key)
+  body = shared_bodies.get(key)
+  if body is not None:
+    return body
+
+  body = cache.client.get(key)
+  if body is None:
+    shared_values = dict(values)
+    shared_values[recipient_field] = RecipientPlaceholder()
+    body = render(name, shared_values)
+    if isinstance(body, str):
+      body = body.decode("utf-8")
+    cache.client.set(key, body, time=SHARED_BODY_TIMEOUT)
+  shared_bodies.set(key, body)
+  return body
+
+def personalize(body, recipient):
+  """
+  Fills the recipient placeholders of a shared body in for recipient
+  """
+  body = body.replace(RECIPIENT_NAME, unicode(recipient))
+  return body.replace(RECIPIENT_KEY, str(recipient.key()))